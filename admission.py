@@ -0,0 +1,107 @@
+"""Admission control of the incoming updates.
+
+Every update is checked before it is parsed, so a rejected update costs no datastore access and no nearby scan.
+Each user has a token bucket: a user sending updates faster than the user rate only slows down themselves.
+The instance has a bucket of the updates it handles per second. When it runs low, its last tokens are kept for
+callback queries and location shares, which continue a conversation the user already started, while /start and
+the other messages are deferred: the user is asked to try again shortly.
+"""
+
+import threading
+import time
+from collections import Counter, OrderedDict
+
+from ratelimit import TokenBucket
+
+# The decisions of AdmissionController.admit().
+ADMITTED = 'admitted'
+DEFERRED = 'deferred'
+DROPPED = 'dropped'
+
+# The kinds of updates that keep the reserved tokens of the instance bucket.
+PRIORITY_KINDS = frozenset(['callback', 'location'])
+
+
+def classify_update(payload):
+    """Get the sender and the kind of an update from its JSON, without parsing it.
+    Args:
+        payload: the update as a dictionary.
+    Returns:
+        A (user id or None, kind) pair; the kind is 'callback', 'location', 'start', 'message' or 'other'.
+    """
+    callback_query = payload.get('callback_query')
+    if callback_query:
+        return (callback_query.get('from') or {}).get('id'), 'callback'
+    message = payload.get('message')
+    if message:
+        user = (message.get('from') or message.get('chat') or {}).get('id')
+        if message.get('location'):
+            return user, 'location'
+        if message.get('text') == '/start':
+            return user, 'start'
+        return user, 'message'
+    return None, 'other'
+
+
+class AdmissionController(object):
+    """Decides whether an update is handled, with a token bucket per user and one for the instance. Thread-safe.
+    The buckets of the max_users most recent users are kept; a user seen again after eviction starts with a
+    full bucket.
+    """
+
+    def __init__(self, user_rate=1.0, user_burst=5, global_rate=20.0, global_burst=40, reserve=0.25,
+                 notice_seconds=10, max_users=10000, clock=time.monotonic):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.global_bucket = TokenBucket(global_rate, global_burst, clock)
+        # The tokens of the instance bucket only priority updates may take
+        self.reserve_tokens = global_burst * reserve
+        self.notice_seconds = notice_seconds
+        self.max_users = max_users
+        self.clock = clock
+        self.stats = Counter()
+        # user id -> [TokenBucket, time of the next "try again" notice]
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+
+    def admit(self, user, kind):
+        """Decide whether to handle an update.
+        Args:
+            user: the Telegram user id of the sender, or None.
+            kind: the kind of update, from classify_update().
+        Returns:
+            A (decision, notify) pair. The decision is ADMITTED, DEFERRED (the instance is overloaded) or
+            DROPPED (the user is over their rate). notify is True if the user should be told to try again,
+            which happens at most once every notice_seconds per user.
+        """
+        user_state = self._user_state(user) if user is not None else None
+        if user_state is not None and not user_state[0].try_acquire():
+            decision = DROPPED
+        elif self.global_bucket.try_acquire(reserve=0 if kind in PRIORITY_KINDS else self.reserve_tokens):
+            decision = ADMITTED
+        else:
+            decision = DEFERRED
+            # The instance is overloaded, not the user: their retry after the "busy" reply must not count as too fast
+            if user_state is not None:
+                user_state[0].refund()
+        with self._lock:
+            self.stats[decision] += 1
+            if decision == ADMITTED:
+                return decision, False
+            self.stats['{}.{}'.format(decision, kind)] += 1
+            now = self.clock()
+            notify = user_state is not None and now >= user_state[1]
+            if notify:
+                user_state[1] = now + self.notice_seconds
+        return decision, notify
+
+    def _user_state(self, user):
+        with self._lock:
+            user_state = self._users.get(user)
+            if user_state is None:
+                user_state = self._users[user] = [TokenBucket(self.user_rate, self.user_burst, self.clock), 0.0]
+                while len(self._users) > self.max_users:
+                    self._users.popitem(last=False)
+            else:
+                self._users.move_to_end(user)
+            return user_state
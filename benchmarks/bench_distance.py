@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+"""Benchmark the vectorized distance engine against per-pair geopy distances.
+
+Checks that the haversine distances stay within geo.HAVERSINE_TOLERANCE of the geodesic distances,
+that within_radius selects exactly the same members as the per-pair scan, and times both at 10k/100k members.
+Usage:
+    python benchmarks/bench_distance.py [member_count ...]
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+from geopy import distance
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+from geo import HAVERSINE_TOLERANCE, haversine_distances, within_radius  # noqa: E402
+
+
+def geodesic_km(point_a, point_b):
+    return distance.distance(point_a, point_b).km
+
+
+def random_members(rng, origin, count, spread_deg=0.1):
+    """Generate member coordinates scattered around the origin."""
+    latitudes = origin[0] + rng.uniform(-spread_deg, spread_deg, count)
+    longitudes = origin[1] + rng.uniform(-spread_deg * 2, spread_deg * 2, count)
+    return np.column_stack((latitudes, longitudes))
+
+
+def check_tolerance(rng, sample_size=2000):
+    """Compare haversine and geodesic distances over the whole globe."""
+    worst = 0.0
+    for _ in range(20):
+        origin = (rng.uniform(-85, 85), rng.uniform(-180, 180))
+        points = random_members(rng, origin, sample_size // 20, spread_deg=1.0)
+        points[:, 0] = np.clip(points[:, 0], -89.9, 89.9)
+        approximate = haversine_distances(origin[0], origin[1], points)
+        exact = np.array([geodesic_km(origin, tuple(point)) for point in points])
+        worst = max(worst, float(np.max(np.abs(approximate - exact) / exact)))
+    assert worst < HAVERSINE_TOLERANCE, 'Haversine error {:.4%} exceeds the tolerance'.format(worst)
+    print('max relative haversine error: {:.4%} (tolerance {:.2%})'.format(worst, HAVERSINE_TOLERANCE))
+
+
+def bench(rng, count, radius_km=3.0):
+    origin = (55.75, 37.62)
+    points = random_members(rng, origin, count)
+
+    started = time.perf_counter()
+    expected = np.array([geodesic_km(origin, tuple(point)) <= radius_km for point in points])
+    per_pair_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    nearby, exact_checks = within_radius(origin[0], origin[1], points, radius_km, geodesic_km)
+    vectorized_seconds = time.perf_counter() - started
+
+    assert np.array_equal(nearby, expected), 'within_radius differs from the per-pair scan'
+    print('{:>7} members: per-pair {:8.3f}s, vectorized {:8.4f}s ({} exact checks), {:.0f}x faster'.format(
+        count, per_pair_seconds, vectorized_seconds, exact_checks, per_pair_seconds / vectorized_seconds))
+
+
+def main(argv):
+    rng = np.random.default_rng(42)
+    check_tolerance(rng)
+    for count in [int(arg) for arg in argv] or [10000, 100000]:
+        bench(rng, count)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
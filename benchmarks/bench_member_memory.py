@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+"""Compare the memory and the nearby scan cost of the member layouts.
+
+The legacy layout is the one main.py used before MemberStore: a dictionary per member with a nested location
+dictionary, plus a second dictionary per member with the values last written to the datastore. Both layouts get
+the same synthetic members; the usernames are created up front, so neither layout is charged for them.
+The memory is measured with tracemalloc. The scan time is the gathering of the candidate coordinates into
+a numpy array, the step of check_who_is_around that touches every candidate.
+Usage:
+    python benchmarks/bench_member_memory.py --members 50000 --orgs 5 --output memory.json
+"""
+
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+
+def synthetic_members(count, orgs, seed):
+    rng = random.Random(seed)
+    org_codes = ['ORG{}'.format(index) for index in range(orgs)]
+    created_dttm = datetime.utcnow().replace(microsecond=0)
+    return [('user{}'.format(index), rng.choice(org_codes), str(rng.randint(1, 4)),
+             rng.uniform(-60, 60), rng.uniform(-180, 180), created_dttm - timedelta(seconds=rng.randint(0, 3600)))
+            for index in range(count)]
+
+
+def build_legacy(rows):
+    members, persisted_members = {}, {}
+    for username, selected_org, travel_radius, latitude, longitude, created_dttm in rows:
+        members[username] = {
+            'selected_org': selected_org,
+            'travel_radius': travel_radius,
+            'location': {'latitude': latitude, 'longitude': longitude},
+            'created_dttm': created_dttm,
+        }
+        persisted_members[username] = {
+            'selected_org': selected_org,
+            'travel_radius': travel_radius,
+            'latitude': latitude,
+            'longitude': longitude,
+            'created_dttm': created_dttm,
+        }
+    return members, persisted_members
+
+
+def build_store(rows):
+    from member_store import MemberStore
+    members = MemberStore()
+    for username, selected_org, travel_radius, latitude, longitude, created_dttm in rows:
+        members.set(username, selected_org=selected_org, travel_radius=travel_radius, latitude=latitude,
+                    longitude=longitude, created_dttm=created_dttm)
+        members.mark_persisted(username)
+    return members
+
+
+def measure_memory(build, rows):
+    """Build a layout under tracemalloc.
+    Returns:
+        The layout and the bytes it holds.
+    """
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    layout = build(rows)
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return layout, after - before
+
+
+def time_gather(gather, candidates, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        gather(candidates)
+    return (time.perf_counter() - started) / repeat * 1000
+
+
+def run(args):
+    sys.path.insert(0, REPO_DIR)
+    import numpy as np
+
+    rows = synthetic_members(args.members, args.orgs, args.seed)
+    (legacy_members, _), legacy_bytes = measure_memory(build_legacy, rows)
+    store, store_bytes = measure_memory(build_store, rows)
+
+    candidates = [row[0] for row in random.Random(args.seed).sample(rows, min(args.candidates, len(rows)))]
+    legacy_ms = time_gather(lambda usernames: np.array([(legacy_members[username]['location']['latitude'],
+                                                         legacy_members[username]['location']['longitude'])
+                                                        for username in usernames]), candidates, args.repeat)
+    store_ms = time_gather(store.coordinates, candidates, args.repeat)
+    return {
+        'parameters': {'members': args.members, 'orgs': args.orgs, 'candidates': len(candidates),
+                       'seed': args.seed},
+        'legacy': {'bytes': legacy_bytes, 'bytes_per_member': legacy_bytes / args.members, 'gather_ms': legacy_ms},
+        'member_store': {'bytes': store_bytes, 'bytes_per_member': store_bytes / args.members,
+                         'gather_ms': store_ms},
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--members', type=int, default=50000, help='number of active members')
+    parser.add_argument('--orgs', type=int, default=5, help='number of organizations')
+    parser.add_argument('--candidates', type=int, default=2000, help='candidates gathered per nearby scan')
+    parser.add_argument('--repeat', type=int, default=50, help='timed scans per layout')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    print('{:<14}{:>14}{:>14}{:>14}'.format('layout', 'MiB', 'bytes/member', 'gather ms'))
+    for layout in ('legacy', 'member_store'):
+        print('{:<14}{:>14.2f}{:>14.1f}{:>14.3f}'.format(layout, results[layout]['bytes'] / 2 ** 20,
+                                                        results[layout]['bytes_per_member'],
+                                                        results[layout]['gather_ms']))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+
+"""Replay synthetic Telegram updates through webhook() and report latency and I/O per update.
+
+The bot runs against the in-memory storage backend and a fake Bot, so no GCP project or Telegram token is needed.
+Every user goes through the usual conversation: /start, the org name, a radius callback and several location shares.
+For every update type the report has the p50/p95/p99 handler latency and the average number of storage reads,
+writes, deletes and queries, Telegram API calls and inline webhook replies per update.
+Usage:
+    python benchmarks/bench_webhook.py --users 1000 --orgs 5 --output results.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+from collections import Counter, defaultdict
+
+REPO_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+
+
+class FakeBot(object):
+    """Stands in for telegram.Bot: every Bot API method only counts the call and optionally sleeps."""
+
+    def __init__(self, latency_ms=0.0):
+        self.latency_ms = latency_ms
+        self.calls = Counter()
+
+    def __getattr__(self, method):
+        if method.startswith('_'):
+            raise AttributeError(method)
+
+        def call(**kwargs):
+            self.calls[method] += 1
+            if self.latency_ms:
+                time.sleep(self.latency_ms / 1000)
+            return True
+        return call
+
+
+class FakeRequest(object):
+    """Stands in for the flask.Request passed to the Cloud Function."""
+    method = 'POST'
+
+    def __init__(self, payload):
+        self.payload = payload
+
+    def get_json(self, force=False):
+        return self.payload
+
+
+class UpdateFactory(object):
+    """Builds Telegram update payloads with increasing update and message ids."""
+
+    def __init__(self):
+        self.update_id = 0
+
+    def _next_id(self):
+        self.update_id += 1
+        return self.update_id
+
+    def _user(self, user_id):
+        return {'id': user_id, 'is_bot': False, 'first_name': 'User', 'username': 'user{}'.format(user_id)}
+
+    def message(self, user_id, **content):
+        message = {'message_id': self._next_id(), 'date': int(time.time()), 'from': self._user(user_id),
+                   'chat': {'id': user_id, 'type': 'private'}}
+        message.update(content)
+        return {'update_id': self.update_id, 'message': message}
+
+    def callback(self, user_id, data):
+        update_id = self._next_id()
+        return {'update_id': update_id, 'callback_query': {
+            'id': str(update_id), 'from': self._user(user_id), 'chat_instance': str(user_id), 'data': data,
+            'message': {'message_id': update_id, 'date': int(time.time()), 'chat': {'id': user_id, 'type': 'private'}},
+        }}
+
+
+def generate_updates(users, orgs, location_shares, seed):
+    """Generate the conversation of every user as (update type, payload builder) pairs.
+    The payloads are built just before they are sent, so the message dates are fresh.
+    Users are interleaved, but the updates of each user keep their order.
+    """
+    rng = random.Random(seed)
+    factory = UpdateFactory()
+    org_codes = ['ORG{}'.format(index) for index in range(orgs)]
+    # Members of the same org are scattered around the same city center
+    centers = {org_code: (rng.uniform(-60, 60), rng.uniform(-180, 180)) for org_code in org_codes}
+    conversations = []
+    for user_id in range(1, users + 1):
+        org_code = rng.choice(org_codes)
+        center = centers[org_code]
+        steps = [
+            ('start', lambda user_id=user_id: factory.message(user_id, text='/start')),
+            ('org_name', lambda user_id=user_id, org_code=org_code: factory.message(user_id, text=org_code.lower())),
+            ('radius', lambda user_id=user_id: factory.callback(user_id, str(rng.randint(1, 4)))),
+        ]
+        for _ in range(location_shares):
+            steps.append(('location', lambda user_id=user_id, center=center: factory.message(user_id, location={
+                'latitude': center[0] + rng.uniform(-0.05, 0.05),
+                'longitude': center[1] + rng.uniform(-0.05, 0.05),
+            })))
+        conversations.append(steps)
+
+    while conversations:
+        conversation = rng.choice(conversations)
+        update_type, build = conversation.pop(0)
+        if not conversation:
+            conversations.remove(conversation)
+        yield update_type, build
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def summarize(samples):
+    latencies = [sample['latency_ms'] for sample in samples]
+    summary = {
+        'updates': len(samples),
+        'p50_ms': percentile(latencies, 0.50),
+        'p95_ms': percentile(latencies, 0.95),
+        'p99_ms': percentile(latencies, 0.99),
+        'max_ms': max(latencies) if latencies else 0.0,
+    }
+    for counter in ('reads', 'writes', 'deletes', 'queries', 'telegram_calls', 'inline_replies'):
+        summary[counter + '_per_update'] = sum(sample[counter] for sample in samples) / max(len(samples), 1)
+    return summary
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    os.environ['STORAGE_BACKEND'] = 'memory'
+    os.environ['AUTHORIZED_ORGS'] = ','.join('ORG{}'.format(index) for index in range(args.orgs))
+    os.environ.setdefault('TELEGRAM_TOKEN', '123456:benchmark')
+    # The simulated users send far faster than real ones, admission control would reject most of the updates
+    os.environ.setdefault('ADMISSION_CONTROL', '0')
+    sys.path.insert(0, REPO_DIR)
+    import main
+    import instrumentation
+    # Sampled and slow traces would be printed in the middle of the report
+    instrumentation.set_exporter(None)
+    # The handlers log every step at INFO, which would dominate the measurement
+    logging.getLogger().setLevel(args.log_level)
+
+    fake_bot = FakeBot(args.telegram_latency_ms)
+    main.get_telegram_client().bot = fake_bot
+
+    samples = defaultdict(list)
+    for update_type, build in generate_updates(args.users, args.orgs, args.location_shares, args.seed):
+        request = FakeRequest(build())
+        main.get_db().reset_stats()
+        calls_before = sum(fake_bot.calls.values())
+        started = time.perf_counter()
+        response = main.webhook(request)
+        latency_ms = (time.perf_counter() - started) * 1000
+        io = main.get_db().reset_stats()
+        samples[update_type].append({
+            'latency_ms': latency_ms,
+            'reads': io['reads'],
+            'writes': io['writes'],
+            'deletes': io['deletes'],
+            'queries': io['queries'],
+            'telegram_calls': sum(fake_bot.calls.values()) - calls_before,
+            'inline_replies': int(isinstance(response, tuple)),
+        })
+
+    all_samples = [sample for update_samples in samples.values() for sample in update_samples]
+    return {
+        'label': args.label,
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'parameters': {'users': args.users, 'orgs': args.orgs, 'location_shares': args.location_shares,
+                       'seed': args.seed, 'telegram_latency_ms': args.telegram_latency_ms},
+        'overall': summarize(all_samples),
+        'by_update_type': {update_type: summarize(update_samples) for update_type, update_samples in samples.items()},
+        'telegram_calls_by_method': dict(fake_bot.calls),
+        'telegram_latency_by_method': main.get_telegram_client().latency_stats(),
+    }
+
+
+def print_report(results):
+    columns = (('updates', 'updates'), ('p50_ms', 'p50 ms'), ('p95_ms', 'p95 ms'), ('p99_ms', 'p99 ms'),
+               ('reads_per_update', 'reads'), ('writes_per_update', 'writes'), ('deletes_per_update', 'deletes'),
+               ('telegram_calls_per_update', 'tg calls'), ('inline_replies_per_update', 'inline'))
+    print('{:<10}'.format('type') + ''.join('{:>10}'.format(title) for _, title in columns))
+    rows = sorted(results['by_update_type'].items()) + [('overall', results['overall'])]
+    for update_type, summary in rows:
+        print('{:<10}'.format(update_type) + ''.join('{:>10.2f}'.format(summary[column]) for column, _ in columns))
+    print('I/O and Telegram calls are averages per update.')
+    print()
+    print('{:<24}{:>10}{:>10}{:>10}{:>10}'.format('telegram method', 'calls', 'errors', 'mean ms', 'max ms'))
+    for method, stats in sorted(results['telegram_latency_by_method'].items()):
+        print('{:<24}{:>10}{:>10}{:>10.2f}{:>10.2f}'.format(method, stats['count'], stats['errors'],
+                                                          stats['total_ms'] / max(stats['count'], 1),
+                                                          stats['max_ms']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=200, help='number of synthetic users')
+    parser.add_argument('--orgs', type=int, default=3, help='number of authorized organizations')
+    parser.add_argument('--location-shares', type=int, default=3, help='location shares per user')
+    parser.add_argument('--telegram-latency-ms', type=float, default=0.0, help='simulated Bot API call latency')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--log-level', default='WARNING', help='log level of the bot while the benchmark runs')
+    parser.add_argument('--label', default=None, help='a name for this run, e.g. the version under test')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    args = parser.parse_args(argv)
+
+    results = run(args)
+    print_report(results)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
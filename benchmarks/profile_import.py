@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+"""Report the cold start cost of the bot: the import time of main and of the dependencies loaded on first use.
+
+Every measurement runs in a fresh interpreter, like a new Cloud Functions instance. The first part is the
+`python -X importtime` profile of `import main`. The second part times the steps of a cold instance handling
+its first updates: importing main, creating the Telegram client and the storage backend, and importing
+geopy/numpy for the first nearby search. The storage backend is the in-memory one, so no GCP project is needed.
+Usage:
+    python benchmarks/profile_import.py [--top 15] [--budget-ms 100] [--output profile.json]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+REPO_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+PHASES_SCRIPT = '''
+import json, time
+started = time.perf_counter()
+phases = []
+def phase(name):
+    global started
+    now = time.perf_counter()
+    phases.append((name, (now - started) * 1000))
+    started = now
+import main
+phase('import main')
+main.get_telegram_client()
+phase('Telegram client (telegram, Bot)')
+main.get_db()
+phase('storage backend (google.cloud.datastore)')
+from telegram import Update
+phase('telegram Update parsing')
+main.compute_point_distance((55.75, 37.62), (55.76, 37.62))
+phase('geopy (first nearby search)')
+from geo import haversine_distances
+haversine_distances(55.75, 37.62, [(55.76, 37.62)])
+phase('numpy (first nearby search)')
+print(json.dumps(phases))
+'''
+
+
+def bot_environment():
+    environment = dict(os.environ)
+    environment.setdefault('TELEGRAM_TOKEN', '123456:profile')
+    environment.setdefault('AUTHORIZED_ORGS', 'PROFILE')
+    environment['STORAGE_BACKEND'] = 'memory'
+    return environment
+
+
+def import_profile():
+    """Run `python -X importtime -c "import main"` and parse its report.
+    Returns:
+        A list of (module, self microseconds, cumulative microseconds) tuples in import order.
+    """
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main'], cwd=REPO_DIR,
+                             env=bot_environment(), stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                             universal_newlines=True, check=True)
+    modules = []
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, module = line[len('import time:'):].split('|')
+        modules.append((module.rstrip(), int(self_us), int(cumulative_us)))
+    return modules
+
+
+def cold_start_phases():
+    """Time the steps of a cold instance handling its first updates.
+    Returns:
+        A list of (phase, milliseconds) pairs.
+    """
+    process = subprocess.run([sys.executable, '-c', PHASES_SCRIPT], cwd=REPO_DIR, env=bot_environment(),
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True, check=True)
+    return [tuple(phase) for phase in json.loads(process.stdout.strip().splitlines()[-1])]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--top', type=int, default=15, help='number of slowest top-level imports to show')
+    parser.add_argument('--budget-ms', type=float, help='exit with an error if importing main takes longer')
+    parser.add_argument('--output', help='write the report to this JSON file')
+    args = parser.parse_args(argv)
+
+    modules = import_profile()
+    main_import = next(module for module in modules if module[0].strip() == 'main')
+    # Top-level imports are the ones main pulled in directly or the interpreter needed
+    top_level = sorted((module for module in modules if not module[0].startswith('  ')),
+                       key=lambda module: -module[2])[:args.top]
+    print('import main: {:.1f} ms'.format(main_import[2] / 1000))
+    for module, _, cumulative_us in top_level:
+        print('  {:>9.1f} ms  {}'.format(cumulative_us / 1000, module.strip()))
+
+    phases = cold_start_phases()
+    print('cold start phases:')
+    for name, milliseconds in phases:
+        print('  {:>9.1f} ms  {}'.format(milliseconds, name))
+    print('  {:>9.1f} ms  total'.format(sum(milliseconds for _, milliseconds in phases)))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump({
+                'import_main_ms': main_import[2] / 1000,
+                'imports': [{'module': module.strip(), 'depth': (len(module) - len(module.lstrip())) // 2,
+                             'self_ms': self_us / 1000, 'cumulative_ms': cumulative_us / 1000}
+                            for module, self_us, cumulative_us in modules],
+                'phases': [{'phase': name, 'ms': milliseconds} for name, milliseconds in phases],
+            }, output, indent=2)
+
+    if args.budget_ms is not None and main_import[2] / 1000 > args.budget_ms:
+        print('import main takes {:.1f} ms, over the {:.1f} ms budget'.format(main_import[2] / 1000, args.budget_ms))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
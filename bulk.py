@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+
+"""Bulk import of organization rosters and export of the organizations and active members.
+
+The import streams a roster into Membership entities, the same entities a user creates by typing the org name.
+The file is read record by record and written with put_multi in Datastore sized batches, several batches in
+parallel, so memory use does not grow with the roster. After every batch that completes in order, the number of
+the last record it covers goes to a checkpoint file; running the same import again resumes after it. Memberships
+are keyed by org and username, so writing a record twice is harmless.
+
+Rosters are CSV files with a header, or JSONL files with one object per line, with the fields `org` and
+`username`. `--org` sets the org of records without one. A leading @ is removed from the usernames.
+The export streams the memberships or today's members as CSV or JSONL.
+Usage:
+    python bulk.py import roster.csv [--org PY] [--format csv|jsonl] [--restart]
+    python bulk.py export memberships|members [--format csv|jsonl] [--output file]
+"""
+
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime
+
+# The columns of the exports.
+EXPORT_FIELDS = {
+    'memberships': ('org', 'username', 'created_dttm'),
+    'members': ('username', 'selected_org', 'travel_radius', 'latitude', 'longitude', 'created_dttm'),
+}
+
+
+class Progress(object):
+    """Reports counters on stderr at most every interval seconds."""
+
+    def __init__(self, action, interval=2.0):
+        self.action = action
+        self.interval = interval
+        self.counts = Counter()
+        self.started = time.monotonic()
+        self._reported = self.started
+
+    def report(self, force=False):
+        now = time.monotonic()
+        if not force and now - self._reported < self.interval:
+            return
+        self._reported = now
+        elapsed = max(now - self.started, 1e-9)
+        details = ', '.join('{} {}'.format(count, name) for name, count in sorted(self.counts.items())
+                            if name != self.action)
+        sys.stderr.write('{} {} ({:.0f}/s{}{})\n'.format(self.action, self.counts[self.action],
+                                                          self.counts[self.action] / elapsed,
+                                                          ', ' if details else '', details))
+        sys.stderr.flush()
+
+
+def guess_format(path):
+    return 'jsonl' if path.endswith(('.jsonl', '.json', '.ndjson')) else 'csv'
+
+
+def read_roster(stream, roster_format, default_org=None):
+    """Read a roster one record at a time.
+    Args:
+        stream: the open roster file.
+        roster_format: 'csv' or 'jsonl'.
+        default_org: Optional. The org of the records without one.
+    Returns:
+        An iterator of (record number from 1, org code or None, username or None) tuples.
+    """
+    if roster_format == 'csv':
+        records = csv.DictReader(stream)
+    else:
+        records = (json.loads(line) for line in stream if line.strip())
+    for number, record in enumerate(records, 1):
+        org_code = (record.get('org') or default_org or '').strip().upper()
+        username = (record.get('username') or '').strip().lstrip('@')
+        yield number, org_code or None, username or None
+
+
+def load_checkpoint(checkpoint_path, roster_path):
+    """Get the number of the last record imported by a previous run of the same roster, 0 if there is none."""
+    try:
+        with open(checkpoint_path) as checkpoint:
+            state = json.load(checkpoint)
+    except (OSError, ValueError):
+        return 0
+    if state.get('roster') != os.path.abspath(roster_path):
+        return 0
+    return state['record']
+
+
+def save_checkpoint(checkpoint_path, roster_path, record):
+    # Written aside and renamed, so a crash never leaves a damaged checkpoint
+    with open(checkpoint_path + '.tmp', 'w') as checkpoint:
+        json.dump({'roster': os.path.abspath(roster_path), 'record': record}, checkpoint)
+    os.replace(checkpoint_path + '.tmp', checkpoint_path)
+
+
+def import_roster(bot, args):
+    """Import a roster into Membership entities.
+    Returns:
+        The process exit code.
+    """
+    checkpoint_path = args.checkpoint or args.roster + '.checkpoint'
+    resume_after = 0 if args.restart else load_checkpoint(checkpoint_path, args.roster)
+    if resume_after:
+        sys.stderr.write('Resuming after record {}\n'.format(resume_after))
+    authorized_orgs = set(os.environ['AUTHORIZED_ORGS'].upper().split(',')) if os.environ.get('AUTHORIZED_ORGS') \
+        else None
+    roster_format = args.format or guess_format(args.roster)
+    db = bot.get_db()
+    progress = Progress('imported')
+    # (last record number, future) of the batches in the order they were submitted
+    in_flight = deque()
+    max_in_flight = bot.DATASTORE_BATCH_WORKERS * 2
+
+    def complete_batches(block):
+        if block and in_flight:
+            wait([future for _, future in in_flight], return_when=FIRST_COMPLETED)
+        # The checkpoint only moves past batches whose predecessors are all written
+        while in_flight and in_flight[0][1].done():
+            last_record, future = in_flight.popleft()
+            progress.counts['imported'] += future.result()
+            save_checkpoint(checkpoint_path, args.roster, last_record)
+        progress.report()
+
+    def write_batch(entities):
+        db.put_multi(entities)
+        return len(entities)
+
+    try:
+        with ThreadPoolExecutor(max_workers=bot.DATASTORE_BATCH_WORKERS) as executor, \
+                open(args.roster, newline='', encoding='utf-8') as stream:
+            batch, number = [], resume_after
+            for number, org_code, username in read_roster(stream, roster_format, args.org):
+                if number <= resume_after:
+                    continue
+                if not org_code or not username:
+                    progress.counts['skipped incomplete'] += 1
+                elif authorized_orgs is not None and org_code not in authorized_orgs:
+                    progress.counts['skipped unauthorized'] += 1
+                else:
+                    batch.append(bot.membership_entity(org_code, username))
+                if len(batch) == bot.DATASTORE_BATCH_SIZE:
+                    in_flight.append((number, executor.submit(write_batch, batch)))
+                    batch = []
+                    complete_batches(block=len(in_flight) >= max_in_flight)
+            if batch:
+                in_flight.append((number, executor.submit(write_batch, batch)))
+            while in_flight:
+                complete_batches(block=True)
+    except Exception as error:
+        progress.report(force=True)
+        sys.stderr.write('Import failed: {}. Run the same command again to resume.\n'.format(error))
+        return 1
+    progress.report(force=True)
+    # The roster is complete, a new run starts from the beginning
+    if os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    return 0
+
+
+def export_rows(bot, kind):
+    """Stream the rows of an export from the datastore.
+    Args:
+        bot: the main module.
+        kind: 'memberships' or 'members'.
+    Returns:
+        An iterator of dictionaries.
+    """
+    db = bot.get_db()
+    if kind == 'memberships':
+        # Organizations that have not been migrated yet keep their members in the legacy 'members' list
+        for org_entity in db.query('Organization'):
+            for username in org_entity.get('members') or []:
+                yield {'org': org_entity.key.name, 'username': username,
+                       'created_dttm': org_entity.get('created_dttm')}
+        for membership in db.query('Membership'):
+            yield {'org': membership.key.parent.name, 'username': membership.key.name,
+                   'created_dttm': membership.get('created_dttm')}
+        return
+
+    # Members written before today are waiting for the sweeper
+    start_of_day = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    for member_entity in db.query('Member', filters=[('created_dttm', '>=', start_of_day)]):
+        yield {
+            'username': member_entity.key.name,
+            'selected_org': member_entity['selected_org'],
+            'travel_radius': member_entity['travel_radius'],
+            'latitude': member_entity['location'].latitude,
+            'longitude': member_entity['location'].longitude,
+            'created_dttm': member_entity['created_dttm'],
+        }
+
+
+def export(bot, args):
+    """Export the memberships or today's members.
+    Returns:
+        The process exit code.
+    """
+    output = open(args.output, 'w', newline='', encoding='utf-8') if args.output else sys.stdout
+    progress = Progress('exported')
+    try:
+        fields = EXPORT_FIELDS[args.kind]
+        if args.format == 'csv':
+            writer = csv.DictWriter(output, fieldnames=fields)
+            writer.writeheader()
+            write = writer.writerow
+        else:
+            def write(row):
+                output.write(json.dumps(row) + '\n')
+        for row in export_rows(bot, args.kind):
+            if row.get('created_dttm') is not None:
+                row['created_dttm'] = bot.utc_naive(row['created_dttm']).isoformat()
+            write(row)
+            progress.counts['exported'] += 1
+            progress.report()
+    finally:
+        if args.output:
+            output.close()
+    progress.report(force=True)
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+    import_parser = commands.add_parser('import', help='import a roster into memberships')
+    import_parser.add_argument('roster', help='the CSV or JSONL roster file')
+    import_parser.add_argument('--org', help='the org of the records without an org field')
+    import_parser.add_argument('--format', choices=('csv', 'jsonl'), help='by default, from the file extension')
+    import_parser.add_argument('--checkpoint', help='the checkpoint file, <roster>.checkpoint by default')
+    import_parser.add_argument('--restart', action='store_true', help='ignore the checkpoint of a previous run')
+    export_parser = commands.add_parser('export', help='export the memberships or the active members')
+    export_parser.add_argument('kind', choices=sorted(EXPORT_FIELDS))
+    export_parser.add_argument('--format', choices=('csv', 'jsonl'), default='csv')
+    export_parser.add_argument('--output', help='the output file, stdout by default')
+    args = parser.parse_args(argv)
+
+    import main as bot
+    if args.command == 'import':
+        return import_roster(bot, args)
+    return export(bot, args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
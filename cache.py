@@ -0,0 +1,43 @@
+"""A small in-process cache with a size bound and an expiry time."""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """A bounded LRU mapping whose entries expire ttl_seconds after they were put. Thread-safe."""
+
+    def __init__(self, max_size=1000, ttl_seconds=300):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Get the value of a key.
+        Returns:
+            The value, or None if the key is missing or expired.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if now >= expires:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        """Set the value of a key, evicting the least recently used entries above max_size."""
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
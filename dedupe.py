@@ -0,0 +1,65 @@
+"""Detect webhook updates that Telegram delivers more than once.
+
+Telegram re-delivers an update when the webhook responds slowly or with an error. Each instance keeps the
+recently seen update ids in a bounded LRU, so a repeated update can be acknowledged before any other work.
+A shared store can back the LRU, to also catch re-deliveries that land on a different instance.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class UpdateDeduplicator(object):
+    """A bounded LRU of claimed update ids with an optional shared backing store.
+    The shared store is a pair of functions: claim(update_id) returns True if no instance claimed the id before,
+    release(update_id) forgets the claim.
+    """
+
+    def __init__(self, max_size=10000, ttl_seconds=600, shared_claim=None, shared_release=None):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.shared_claim = shared_claim
+        self.shared_release = shared_release
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+
+    def claim(self, update_id):
+        """Claim an update before handling it.
+        Args:
+            update_id: the update_id of the Telegram update.
+        Returns:
+            True if the update is new, False if it was already claimed within the TTL.
+        Raises:
+            Whatever the shared claim raises; the update is then not claimed.
+        """
+        now = time.monotonic()
+        with self._lock:
+            claimed = self._seen.get(update_id)
+            if claimed is not None and now - claimed < self.ttl_seconds:
+                self._seen.move_to_end(update_id)
+                return False
+            self._seen[update_id] = now
+            self._seen.move_to_end(update_id)
+            while len(self._seen) > self.max_size:
+                self._seen.popitem(last=False)
+        if self.shared_claim:
+            try:
+                if not self.shared_claim(update_id):
+                    return False
+            except Exception:
+                # The update was not claimed anywhere, its re-delivery has to be handled
+                with self._lock:
+                    self._seen.pop(update_id, None)
+                raise
+        return True
+
+    def release(self, update_id):
+        """Forget the claim of an update that failed, so that its re-delivery is handled.
+        Args:
+            update_id: the update_id of the Telegram update.
+        """
+        with self._lock:
+            self._seen.pop(update_id, None)
+        if self.shared_release:
+            self.shared_release(update_id)
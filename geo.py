@@ -0,0 +1,227 @@
+"""Geospatial helpers for finding members near each other.
+
+The members of an organization are bucketed into a fixed latitude/longitude grid, so a radius query
+only has to look at the few cells that can contain a point within the requested distance.
+The grid is only a pre-filter: the candidates are then measured in one vectorized haversine pass,
+and only the ones close to the radius boundary need an exact geodesic distance.
+"""
+
+import heapq
+import math
+import threading
+from collections import defaultdict
+
+# Grid cell size in degrees. 0.05 degrees of latitude is ~5.5 km, so the 1-4 km radius choices
+# of the distance selector usually touch only a 3x3 block of cells.
+CELL_SIZE_DEG = 0.05
+
+# Number of grid columns around the globe, used to wrap longitudes across the antimeridian.
+LON_CELLS = int(round(360 / CELL_SIZE_DEG))
+
+# The shortest length of one degree of latitude on the WGS-84 ellipsoid (at the equator) and the length
+# of one degree of longitude on the equator, in kilometers. Using the smallest possible values keeps the
+# candidate search conservative.
+KM_PER_DEG_LAT_MIN = 110.574
+KM_PER_DEG_LON_EQUATOR = 111.319
+
+# Extra relative margin added to the search window, so rounding never excludes a point on the boundary.
+SEARCH_MARGIN = 1.05
+
+# Mean Earth radius in kilometers used by the spherical (haversine) approximation.
+EARTH_RADIUS_KM = 6371.0088
+
+# The haversine distance differs from the WGS-84 geodesic distance by less than 0.6%.
+# Distances within this relative tolerance of the radius are re-checked with the exact distance function.
+HAVERSINE_TOLERANCE = 0.01
+
+
+def cell_of(latitude, longitude):
+    """Compute the grid cell that contains the given point.
+    Args:
+        latitude: latitude of the point in degrees.
+        longitude: longitude of the point in degrees.
+    Returns:
+        A (row, column) tuple.
+    """
+    row = int(math.floor(latitude / CELL_SIZE_DEG))
+    column = int(math.floor(longitude / CELL_SIZE_DEG)) % LON_CELLS
+    return row, column
+
+
+class GeoGridIndex(object):
+    """An in-memory grid index of member locations.
+    Each username is stored in exactly one cell. Updating a username moves it to its new cell.
+    The index is thread-safe.
+    """
+
+    def __init__(self):
+        self._cells = defaultdict(set)
+        self._user_cells = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._user_cells)
+
+    def __contains__(self, username):
+        return username in self._user_cells
+
+    def update(self, username, latitude, longitude):
+        """Add a username to the index or move it to a new location.
+        Args:
+            username: the member to index.
+            latitude: latitude of the member's location in degrees.
+            longitude: longitude of the member's location in degrees.
+        """
+        cell = cell_of(latitude, longitude)
+        with self._lock:
+            previous_cell = self._user_cells.get(username)
+            if previous_cell == cell:
+                return
+            if previous_cell is not None:
+                self._discard_from_cell(username, previous_cell)
+            self._cells[cell].add(username)
+            self._user_cells[username] = cell
+
+    def remove(self, username):
+        """Remove a username from the index if it is there.
+        Args:
+            username: the member to remove.
+        """
+        with self._lock:
+            cell = self._user_cells.pop(username, None)
+            if cell is not None:
+                self._discard_from_cell(username, cell)
+
+    def candidates(self, latitude, longitude, radius_km):
+        """Find the usernames that may be within the given distance of a point.
+        Every username within radius_km is returned, but some of the returned usernames may be further away.
+        Args:
+            latitude: latitude of the search origin in degrees.
+            longitude: longitude of the search origin in degrees.
+            radius_km: search radius in kilometers.
+        Returns:
+            A set of usernames.
+        """
+        lat_span = radius_km / KM_PER_DEG_LAT_MIN * SEARCH_MARGIN
+        max_abs_latitude = abs(latitude) + lat_span
+        if max_abs_latitude >= 89.0:
+            # Near the poles the longitude span degenerates, fall back to every indexed username.
+            with self._lock:
+                return set(self._user_cells)
+        lon_span = radius_km / (KM_PER_DEG_LON_EQUATOR * math.cos(math.radians(max_abs_latitude))) * SEARCH_MARGIN
+        if lon_span >= 180.0:
+            with self._lock:
+                return set(self._user_cells)
+
+        min_row, min_column = cell_of(latitude - lat_span, longitude - lon_span)
+        max_row = cell_of(latitude + lat_span, longitude)[0]
+        column_count = int(math.floor((longitude + lon_span) / CELL_SIZE_DEG)) - \
+            int(math.floor((longitude - lon_span) / CELL_SIZE_DEG)) + 1
+
+        result = set()
+        with self._lock:
+            for row in range(min_row, max_row + 1):
+                for offset in range(min(column_count, LON_CELLS)):
+                    cell = self._cells.get((row, (min_column + offset) % LON_CELLS))
+                    if cell:
+                        result.update(cell)
+        return result
+
+    def _discard_from_cell(self, username, cell):
+        usernames = self._cells[cell]
+        usernames.discard(username)
+        if not usernames:
+            del self._cells[cell]
+
+
+def haversine_distance(latitude_a, longitude_a, latitude_b, longitude_b):
+    """Compute the great-circle distance between two points.
+    Args:
+        latitude_a: latitude of the first point in degrees.
+        longitude_a: longitude of the first point in degrees.
+        latitude_b: latitude of the second point in degrees.
+        longitude_b: longitude of the second point in degrees.
+    Returns:
+        The distance in kilometers.
+    """
+    lat_a = math.radians(latitude_a)
+    lat_b = math.radians(latitude_b)
+    a = math.sin((lat_b - lat_a) / 2) ** 2 + \
+        math.cos(lat_a) * math.cos(lat_b) * math.sin(math.radians(longitude_b - longitude_a) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(1.0, a)))
+
+
+def haversine_distances(latitude, longitude, coordinates):
+    """Compute the great-circle distances from one origin to many points in a single vectorized pass.
+    Args:
+        latitude: latitude of the origin in degrees.
+        longitude: longitude of the origin in degrees.
+        coordinates: a NumPy array of shape (n, 2) holding (latitude, longitude) pairs in degrees.
+    Returns:
+        A NumPy array of n distances in kilometers.
+    """
+    # numpy is imported on first use, the grid index does not need it
+    import numpy as np
+
+    coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+    lat_a = math.radians(latitude)
+    lat_b = np.radians(coordinates[:, 0])
+    half_dlat = (lat_b - lat_a) / 2
+    half_dlon = (np.radians(coordinates[:, 1]) - math.radians(longitude)) / 2
+    a = np.sin(half_dlat) ** 2 + math.cos(lat_a) * np.cos(lat_b) * np.sin(half_dlon) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+def within_radius(latitude, longitude, coordinates, radius_km, exact_distance):
+    """Select the points within the given distance of an origin.
+    The points that are clearly inside or outside the radius are classified by the haversine distance.
+    Only the points within HAVERSINE_TOLERANCE of the radius are measured with exact_distance,
+    so the result is the same as calling exact_distance for every point.
+    Args:
+        latitude: latitude of the origin in degrees.
+        longitude: longitude of the origin in degrees.
+        coordinates: a NumPy array of shape (n, 2) holding (latitude, longitude) pairs in degrees.
+        radius_km: search radius in kilometers.
+        exact_distance: a function (origin, point) -> kilometers, taking (latitude, longitude) tuples.
+    Returns:
+        A tuple of a boolean NumPy array marking the points within the radius and the number of exact checks.
+    """
+    _, inside, exact_checks = _classify(latitude, longitude, coordinates, radius_km, exact_distance)
+    return inside, exact_checks
+
+
+def nearest_within_radius(latitude, longitude, coordinates, radius_km, exact_distance, limit):
+    """Select the nearest points within the given distance of an origin, closest first.
+    The points are selected like within_radius() does; only the `limit` nearest of them are kept, with a bounded
+    heap, so a busy area does not produce an unbounded result.
+    Args:
+        latitude: latitude of the origin in degrees.
+        longitude: longitude of the origin in degrees.
+        coordinates: a NumPy array of shape (n, 2) holding (latitude, longitude) pairs in degrees.
+        radius_km: search radius in kilometers.
+        exact_distance: a function (origin, point) -> kilometers, taking (latitude, longitude) tuples.
+        limit: the maximum number of points to return.
+    Returns:
+        A tuple of the list of (distance in km, position in coordinates) pairs, the number of points within
+        the radius, and the number of exact checks.
+    """
+    import numpy as np
+
+    approximate, inside, exact_checks = _classify(latitude, longitude, coordinates, radius_km, exact_distance)
+    positions = np.flatnonzero(inside)
+    nearest = heapq.nsmallest(limit, zip(approximate[positions].tolist(), positions.tolist()))
+    return nearest, len(positions), exact_checks
+
+
+def _classify(latitude, longitude, coordinates, radius_km, exact_distance):
+    import numpy as np
+
+    approximate = haversine_distances(latitude, longitude, coordinates)
+    inside = approximate <= radius_km * (1 - HAVERSINE_TOLERANCE)
+    boundary = np.flatnonzero((approximate > radius_km * (1 - HAVERSINE_TOLERANCE)) &
+                              (approximate <= radius_km * (1 + HAVERSINE_TOLERANCE)))
+    origin = (latitude, longitude)
+    for position in boundary:
+        point = coordinates[position]
+        inside[position] = exact_distance(origin, (float(point[0]), float(point[1]))) <= radius_km
+    return approximate, inside, len(boundary)
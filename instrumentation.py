@@ -0,0 +1,137 @@
+"""Low overhead per-update instrumentation.
+
+Every webhook update gets a trace. The code handling the update records spans (a name, a duration and optional
+attributes) for the handler, the storage calls and the Telegram calls, and increments counters, e.g. the number
+of candidates checked by the nearby search. When the update is done, the trace is handed to the exporter if it is
+sampled (TRACE_SAMPLE_RATE) or slow (TRACE_SLOW_MS). The default exporter prints one JSON line, which Cloud
+Functions turns into a structured log entry. Use set_exporter() to send the traces somewhere else.
+
+Recording is cheap: without a current trace, span() and increment() do nothing.
+"""
+
+import json
+import os
+import random
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+# The fraction of the updates whose traces are exported.
+TRACE_SAMPLE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "0.01"))
+
+# Traces of updates slower than this are always exported.
+TRACE_SLOW_MS = float(os.environ.get("TRACE_SLOW_MS", "2000"))
+
+_local = threading.local()
+
+
+class Trace(object):
+    """The spans and counters recorded while handling one update. Spans may be added from other threads."""
+
+    def __init__(self, name, attributes):
+        self.name = name
+        self.attributes = attributes
+        self.started = time.perf_counter()
+        self.duration_ms = None
+        self.spans = []
+        self.counters = Counter()
+        self._lock = threading.Lock()
+
+    def add_span(self, name, duration_ms, attributes=None):
+        with self._lock:
+            self.spans.append((name, duration_ms, attributes))
+
+    def increment(self, counter, value=1):
+        with self._lock:
+            self.counters[counter] += value
+
+    def to_dict(self):
+        return {
+            'trace': self.name,
+            'duration_ms': round(self.duration_ms, 3) if self.duration_ms is not None else None,
+            'attributes': self.attributes,
+            'spans': [dict(attributes or {}, name=name, duration_ms=round(duration_ms, 3))
+                      for name, duration_ms, attributes in self.spans],
+            'counters': dict(self.counters),
+        }
+
+
+def log_exporter(trace):
+    """Print the trace as one JSON line, a structured log entry on Cloud Functions."""
+    print(json.dumps(dict(trace.to_dict(), severity='INFO', message='trace ' + trace.name)))
+
+
+_exporter = log_exporter
+
+
+def set_exporter(exporter):
+    """Replace the trace exporter.
+    Args:
+        exporter: a function taking a finished Trace, or None to stop exporting.
+    """
+    global _exporter
+    _exporter = exporter
+
+
+def current_trace():
+    """Get the trace of the current thread, or None."""
+    return getattr(_local, 'trace', None)
+
+
+def start_trace(name, **attributes):
+    """Start the trace of an update on the current thread.
+    Args:
+        name: the trace name, e.g. 'update'.
+        attributes: values describing the update, e.g. its type.
+    Returns:
+        The Trace.
+    """
+    trace = Trace(name, attributes)
+    _local.trace = trace
+    return trace
+
+
+def finish_trace():
+    """Finish the trace of the current thread and export it if it is sampled or slow.
+    Returns:
+        The finished Trace, or None if there was none.
+    """
+    trace = current_trace()
+    _local.trace = None
+    if trace is None:
+        return None
+    trace.duration_ms = (time.perf_counter() - trace.started) * 1000
+    if _exporter and (trace.duration_ms >= TRACE_SLOW_MS or random.random() < TRACE_SAMPLE_RATE):
+        _exporter(trace)
+    return trace
+
+
+@contextmanager
+def span(name, trace=None, **attributes):
+    """Record the duration of a block as a span of the current trace.
+    Args:
+        name: the span name, e.g. 'datastore.query'.
+        trace: Optional. The trace to record into, the current one by default.
+        attributes: values describing the span, e.g. the entity kind.
+    """
+    trace = trace or current_trace()
+    if trace is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        trace.add_span(name, (time.perf_counter() - started) * 1000, attributes or None)
+
+
+def increment(counter, value=1):
+    """Increment a counter of the current trace.
+    Args:
+        counter: the counter name, e.g. 'nearby.candidates'.
+        value: Optional. The increment, 1 by default.
+    """
+    trace = current_trace()
+    if trace is not None:
+        trace.increment(counter, value)
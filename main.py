@@ -9,17 +9,25 @@ This Bot is a Google Cloud function. It also uses Google Cloud Datastore.
 This program is dedicated to the public domain under the MIT License.
 """
 
+import json
 import logging
 import os
+import threading
+import time
+import uuid
 from collections import defaultdict
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
 
-from telegram import Bot, ChatAction, Update, InlineKeyboardButton, InlineKeyboardMarkup, KeyboardButton, \
-    ReplyKeyboardMarkup, ReplyKeyboardRemove
+# Measure the cold start of the instance, from here to the end of the first update
+IMPORT_STARTED = time.perf_counter()
 
-from google.cloud import datastore
-
-from geopy import distance
+# Only lightweight modules are imported here. telegram, google.cloud.datastore, geopy and numpy are imported
+# by the code paths that need them, and the clients are created on first use, to keep cold starts short.
+from geo import GeoGridIndex, haversine_distance  # noqa: E402
+from instrumentation import finish_trace, increment, span, start_trace  # noqa: E402
+from member_store import MemberStore  # noqa: E402
 
 # Enable logging
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -27,33 +35,285 @@ logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s
 logger = logging.getLogger(__name__)
 
 # Define global vars and constants
-bot = Bot(token=os.environ["TELEGRAM_TOKEN"])
-db = datastore.Client()
+# The number of outbound Telegram API calls that can run concurrently.
+TELEGRAM_WORKERS = int(os.environ.get("TELEGRAM_WORKERS", "4"))
+
+# The number of threads handling updates, each of which may make synchronous Telegram API calls.
+# One on Cloud Functions; the long running server sets it to its concurrency.
+TELEGRAM_HANDLER_THREADS = int(os.environ.get("TELEGRAM_HANDLER_THREADS", "1"))
+
+# Return the last reply of a handler in the webhook response instead of a separate request.
+WEBHOOK_INLINE_REPLY = os.environ.get("WEBHOOK_INLINE_REPLY", "1") == "1"
+
+# The Telegram client and the storage backend, created on first use by get_telegram_client() and get_db().
+# All persistence goes through the storage backend selected by STORAGE_BACKEND, Google Cloud Datastore by default.
+clients = {}
+clients_lock = threading.Lock()
+
+# The module import time and whether the first update has been handled, for the cold start report.
+cold_start = {'import_seconds': None, 'first_update_done': False}
+
+# A dictionary of sets holding organizations as keys and members belonging to them as values (sets).
+# A user can be in several orgs. In the datastore each membership is a Membership entity,
+# a child of the Organization key named after the username.
+organizations = defaultdict(set)
+
+# The reverse index of organizations: members as keys and the sets of their orgs as values.
+# In the datastore it is the indexed 'username' property of the Membership entities.
+user_orgs = defaultdict(set)
+
+# The members active today and their preferences, in compact columns:
+# members.selected_org('pytonist') == 'Pythonists', members.travel_radius('pytonist') == 3.0,
+# members.location('pytonist') == (55.45, 37.742), members.created_dttm('pytonist') == datetime(2019, 5, 1, 10, 30)
+# created_dttm is the last time the member was written to the datastore. The store also keeps the last values
+# written to or read from the datastore by this instance, to skip redundant writes.
+members = MemberStore()
+
+# A spatial index of the member locations, used to find members near a given location.
+members_index = GeoGridIndex()
+
+# The members who opted in to the nearby notifications with /notify, synced like the organizations. In the
+# datastore they are the Subscriber entities with 'enabled' set; opting out keeps the entity, so that the
+# incremental syncs of the other instances see it.
+subscribers = set()
+
+# How often an instance reloads organizations and members in full. In between, /start only fetches
+# the entities changed since the last sync.
+FULL_SYNC_TTL_SECONDS = int(os.environ.get("FULL_SYNC_TTL_SECONDS", "600"))
+
+# Entities written by other instances shortly before the last sync are fetched again, to tolerate clock skew.
+SYNC_WATERMARK_OVERLAP = timedelta(seconds=5)
+
+# The maximum number of keys Datastore accepts in a single batch operation.
+DATASTORE_BATCH_SIZE = 500
+
+# The number of batch operations (e.g. the expiry sweeper deletes) run in parallel.
+DATASTORE_BATCH_WORKERS = int(os.environ.get("DATASTORE_BATCH_WORKERS", "4"))
+
+# Member writes are buffered during an update and flushed together with put_multi at its end.
+# A location share is not written if the member moved less than this distance since the last write of the
+# same org and radius, unless that write was on an earlier UTC day and the member would expire.
+MEMBER_WRITE_MIN_MOVE_KM = float(os.environ.get("MEMBER_WRITE_MIN_MOVE_KM", "0.1"))
+
+# The usernames with changes waiting to be written to the datastore.
+pending_member_writes = set()
+pending_member_writes_lock = threading.Lock()
+
+# Load the snapshot written by build_snapshot() when a cold instance syncs for the first time, instead of
+# scanning the Membership and Member kinds.
+SNAPSHOT_WARMUP = os.environ.get("SNAPSHOT_WARMUP", "1") == "1"
+
+# The snapshot is split into entities of at most this size, below the Datastore limit of 1 MiB per entity.
+SNAPSHOT_CHUNK_BYTES = 1000000
+
+# Update ids seen by this instance are kept in an LRU of this size, to acknowledge Telegram re-deliveries at once.
+DEDUPE_CACHE_SIZE = int(os.environ.get("DEDUPE_CACHE_SIZE", "10000"))
+
+# How long an update id is remembered.
+DEDUPE_TTL_SECONDS = int(os.environ.get("DEDUPE_TTL_SECONDS", "600"))
+
+# Also record the update ids in the datastore, to catch re-deliveries that land on another instance.
+DEDUPE_SHARED = os.environ.get("DEDUPE_SHARED", "0") == "1"
+
+# Admission control of the incoming updates, see admission.py. A user may send ADMISSION_USER_RATE updates per
+# second, with bursts of ADMISSION_USER_BURST. An instance handles ADMISSION_GLOBAL_RATE updates per second, with
+# bursts of ADMISSION_GLOBAL_BURST, and keeps the last ADMISSION_RESERVE of them for callbacks and locations.
+# A rejected update gets a "try again" reply, at most once every ADMISSION_NOTICE_SECONDS per user.
+ADMISSION_CONTROL = os.environ.get("ADMISSION_CONTROL", "1") == "1"
+ADMISSION_USER_RATE = float(os.environ.get("ADMISSION_USER_RATE", "1"))
+ADMISSION_USER_BURST = int(os.environ.get("ADMISSION_USER_BURST", "5"))
+ADMISSION_GLOBAL_RATE = float(os.environ.get("ADMISSION_GLOBAL_RATE", "20"))
+ADMISSION_GLOBAL_BURST = int(os.environ.get("ADMISSION_GLOBAL_BURST", "40"))
+ADMISSION_RESERVE = float(os.environ.get("ADMISSION_RESERVE", "0.25"))
+ADMISSION_NOTICE_SECONDS = int(os.environ.get("ADMISSION_NOTICE_SECONDS", "10"))
+
+# The nearby search keeps the NEARBY_MAX_RESULTS nearest members, and replies with NEARBY_PAGE_SIZE of them at
+# a time. The other pages are served for NEARBY_RESULTS_TTL_SECONDS from a NearbyResults entity, which any instance
+# can read with a single get, and from a cache on the instance that did the search.
+NEARBY_PAGE_SIZE = int(os.environ.get("NEARBY_PAGE_SIZE", "10"))
+NEARBY_MAX_RESULTS = int(os.environ.get("NEARBY_MAX_RESULTS", "50"))
+NEARBY_RESULTS_TTL_SECONDS = int(os.environ.get("NEARBY_RESULTS_TTL_SECONDS", "300"))
+
+# A member who opted in with /notify is told about the same neighbour at most once in this many seconds.
+NOTIFY_DEDUPE_SECONDS = int(os.environ.get("NOTIFY_DEDUPE_SECONDS", "3600"))
+
+# Telegram allows about 30 messages per second overall and one message per second per chat.
+TELEGRAM_GLOBAL_RATE = float(os.environ.get("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_CHAT_RATE = float(os.environ.get("TELEGRAM_CHAT_RATE", "1"))
+
+# How long one deliver_notifications() call keeps sending, and how many notifications it loads at a time.
+NOTIFY_DELIVERY_SECONDS = float(os.environ.get("NOTIFY_DELIVERY_SECONDS", "50"))
+NOTIFY_BATCH_SIZE = 100
+
+# Serializes the syncs of the instance state, and guards the org sets against concurrent changes while they
+# are read. Both only matter to the long running server, where handlers run on several threads.
+sync_lock = threading.Lock()
+organizations_lock = threading.Lock()
+
+# Serializes the changes of the members store by the handlers, the flushes and the syncs. A full sync builds a new
+# members store and spatial index and swaps them in while holding it, so no change is lost in between.
+members_lock = threading.Lock()
+
+# The sync state of the current instance. The watermarks are the created_dttm values already synced.
+sync_state = {
+    'full_sync_dttm': None,
+    'org_watermark': None,
+    'member_watermark': None,
+    'subscriber_watermark': None,
+}
+
+
+def get_client(name, factory):
+    """Get a client of the current instance, creating it on first use.
+    Args:
+        name: the client name in the clients dictionary.
+        factory: a function creating the client.
+    Returns:
+        The client.
+    """
+    client = clients.get(name)
+    if client is None:
+        with clients_lock:
+            client = clients.get(name)
+            if client is None:
+                started = time.perf_counter()
+                client = clients[name] = factory()
+                logger.info('Created the {} client in {:.1f} ms'.format(name, (time.perf_counter() - started) * 1000))
+    return client
+
+
+def get_db():
+    """Get the storage backend, created on first use.
+    Returns:
+        A storage.Storage object.
+    """
+    def create_storage():
+        from storage import storage_from_env
+        return storage_from_env()
+    return get_client('storage', create_storage)
 
-# A dictionary of lists holding organizations as keys and members belonging to them as values (lists).
-# A user can be in several orgs
-organizations = defaultdict(list)
 
-# A dictionary holding members as keys and their preferences as values.
-# members['pytonist'] =
-# {'selected_org': 'Pythonists', 'travel_radius': '3', 'location': {'longitude': 37.742, 'latitude': 55.45}}
-members = {}
+def get_telegram_client():
+    """Get the Telegram client, created on first use.
+    Returns:
+        A telegram_api.TelegramClient object.
+    """
+    def create_telegram_client():
+        from telegram_api import TelegramClient, build_bot
+        return TelegramClient(build_bot(os.environ["TELEGRAM_TOKEN"], TELEGRAM_WORKERS, TELEGRAM_HANDLER_THREADS),
+                              workers=TELEGRAM_WORKERS, inline_replies=WEBHOOK_INLINE_REPLY)
+    return get_client('telegram', create_telegram_client)
+
 
+def get_nearby_results():
+    """Get the cache of the nearby search results, created on first use. The keys are random tokens, the values
+    (username, [(member, distance in km), ...]) pairs.
+    Returns:
+        A cache.TTLCache object.
+    """
+    def create_nearby_results():
+        from cache import TTLCache
+        return TTLCache(max_size=1000, ttl_seconds=NEARBY_RESULTS_TTL_SECONDS)
+    return get_client('nearby_results', create_nearby_results)
 
-def db_query_by_kind(kind):
+
+def get_update_deduplicator():
+    """Get the update_id deduplicator, created on first use.
+    Returns:
+        A dedupe.UpdateDeduplicator object.
+    """
+    def create_update_deduplicator():
+        from dedupe import UpdateDeduplicator
+        if DEDUPE_SHARED:
+            return UpdateDeduplicator(DEDUPE_CACHE_SIZE, DEDUPE_TTL_SECONDS,
+                                      shared_claim=db_claim_update, shared_release=db_release_update)
+        return UpdateDeduplicator(DEDUPE_CACHE_SIZE, DEDUPE_TTL_SECONDS)
+    return get_client('dedupe', create_update_deduplicator)
+
+
+def get_admission_controller():
+    """Get the admission controller of the incoming updates, created on first use.
+    Returns:
+        An admission.AdmissionController object.
+    """
+    def create_admission_controller():
+        from admission import AdmissionController
+        return AdmissionController(ADMISSION_USER_RATE, ADMISSION_USER_BURST, ADMISSION_GLOBAL_RATE,
+                                   ADMISSION_GLOBAL_BURST, ADMISSION_RESERVE, ADMISSION_NOTICE_SECONDS)
+    return get_client('admission', create_admission_controller)
+
+
+def db_query_by_kind(kind, changed_since=None):
     """Query the datastore by entity kind (e.g. Organization, Member). The result is a list of Entities.
     To get an entity's id do result[index].id. If the id is custom, do result[index].key.name
     To get entity's items do result[index].items(). It can be converted to list result[index]['members'].
     Args:
         kind: GCP datastore entity kind.
+        changed_since: Optional. Only return the entities with created_dttm later than this UTC datetime.
     Returns:
         A list of entities of the specified kind.
     """
-    logger.info("In db_query_by_kind handler.")
-    query = db.query(kind=kind)
-    # query.add_filter('priority', '>=', 4)
-    # query.order = ['-priority']
-    return list(query.fetch())
+    logger.debug("In db_query_by_kind handler.")
+    filters = [('created_dttm', '>', changed_since)] if changed_since else []
+    with span('datastore.query', kind=kind):
+        return list(get_db().query(kind, filters=filters))
+
+
+def db_count_by_kind(kind, changed_since=None):
+    """Count the entities of a kind in the datastore without loading them.
+    Args:
+        kind: GCP datastore entity kind.
+        changed_since: Optional. Only count the entities with created_dttm later than this UTC datetime.
+    Returns:
+        The number of entities.
+    """
+    logger.debug("In db_count_by_kind handler.")
+    filters = [('created_dttm', '>', changed_since)] if changed_since else []
+    with span('datastore.count', kind=kind):
+        return get_db().count(kind, filters=filters)
+
+
+def db_query_keys(kind, created_before=None):
+    """Query the datastore for the keys of the entities of a kind, without loading the entities.
+    Args:
+        kind: GCP datastore entity kind.
+        created_before: Optional. Only return the keys of the entities with created_dttm earlier than this UTC datetime.
+    Returns:
+        A list of keys.
+    """
+    logger.debug("In db_query_keys handler.")
+    filters = [('created_dttm', '<', created_before)] if created_before else []
+    with span('datastore.query_keys', kind=kind):
+        return [entity.key for entity in get_db().query(kind, filters=filters, keys_only=True)]
+
+
+def db_run_in_chunks(operation, items):
+    """Run a Datastore batch operation in Datastore sized chunks, several chunks in parallel.
+    Args:
+        operation: the batch operation, e.g. get_db().put_multi or get_db().delete_multi.
+        items: the entities or keys to pass to the operation.
+    Returns:
+        The number of processed items.
+    """
+    chunks = [items[i:i + DATASTORE_BATCH_SIZE] for i in range(0, len(items), DATASTORE_BATCH_SIZE)]
+    with span('datastore.' + operation.__name__, items=len(items)):
+        if len(chunks) > 1:
+            with ThreadPoolExecutor(max_workers=DATASTORE_BATCH_WORKERS) as executor:
+                list(executor.map(operation, chunks))
+        elif chunks:
+            operation(chunks[0])
+    return len(items)
+
+
+def db_delete_keys(keys):
+    """Delete entities in Datastore sized chunks, several chunks in parallel.
+    Args:
+        keys: the keys of the entities to delete.
+    Returns:
+        The number of deleted entities.
+    """
+    logger.debug("In db_delete_keys handler.")
+    return db_run_in_chunks(get_db().delete_multi, keys)
 
 
 def db_get_entity(kind, entity_name):
@@ -64,9 +324,11 @@ def db_get_entity(kind, entity_name):
     Returns:
         The found entity if any.
     """
-    logger.info("In db_get_entity handler.")
+    logger.debug("In db_get_entity handler.")
+    db = get_db()
     key = db.key(kind, entity_name)
-    task = db.get(key)
+    with span('datastore.get', kind=kind):
+        task = db.get(key)
     return task
 
 
@@ -78,113 +340,677 @@ def db_batch_lookup(kind, entity_names):
     Returns:
         The found entities if any.
     """
-    logger.info("In db_batch_lookup handler.")
+    logger.debug("In db_batch_lookup handler.")
+    db = get_db()
     keys = [db.key(kind, entity_name) for entity_name in entity_names]
-    tasks = db.get_multi(keys)
+    with span('datastore.get_multi', kind=kind):
+        tasks = db.get_multi(keys)
     return tasks
 
 
-def db_upsert_org(org_cd, org_members):
-    """Upsert the specified organization.
+def membership_entity(org_cd, username, created_dttm=None):
+    """Build the Membership entity of a user in an organization.
     Args:
-        org_cd: organization name to upsert.
-        org_members: values to assign to the 'members' property .
+        org_cd: organization name.
+        username: member name.
+        created_dttm: Optional. When the user joined, now by default.
     Returns:
-        The created/updated organization entity.
+        The Membership entity.
     """
-    logger.info("In db_upsert_org handler.")
-    task = datastore.Entity(db.key('Organization', org_cd), exclude_from_indexes=('members',))
-    task.update({'members': org_members})
-    db.put(task)
+    db = get_db()
+    task = db.entity(db.key('Organization', org_cd, 'Membership', username))
+    task.update({'username': username, 'created_dttm': created_dttm or datetime.utcnow()})
     return task
 
 
-def db_upsert_member(username, selected_org, travel_radius, location):
-    """Upsert the specified member.
+def db_add_membership(org_cd, username):
+    """Add a user to an organization. This is a single small write that does not contend with other joins,
+    and it is idempotent: adding an existing member again does not change anything.
+    Args:
+        org_cd: organization name.
+        username: member name to add.
+    Returns:
+        True if the user was added, False if they already were a member.
+    """
+    logger.debug("In db_add_membership handler.")
+    with span('datastore.add_if_absent', kind='Membership'):
+        return get_db().add_if_absent(membership_entity(org_cd, username))
+
+
+def member_entity(username, selected_org, travel_radius, location):
+    """Build the Member entity of a member.
     Args:
-        username: member name to upsert.
+        username: member name.
         selected_org: value to assign to the 'selected_org' property .
-        travel_radius: value to assign to the 'travel_radius' property .
-        location: value to assign to the 'location' property .
+        travel_radius: the travel radius in km, stored as the string the radius buttons send, e.g. '3'.
+        location: the (latitude, longitude) pair to assign to the 'location' property .
     Returns:
-        The created/updated member entity.
+        The Member entity.
     """
-    logger.info("In db_upsert_member handler.")
-    task = datastore.Entity(db.key('Member', username), exclude_from_indexes=('travel_radius', 'location',))
+    from storage import GeoPoint
+    db = get_db()
+    task = db.entity(db.key('Member', username), exclude_from_indexes=('travel_radius', 'location',))
     task.update(
         {
             'selected_org': selected_org,
-            'travel_radius': travel_radius,
-            'location': datastore.helpers.GeoPoint(location['latitude'], location['longitude']),
+            'travel_radius': '{:g}'.format(float(travel_radius)),
+            'location': GeoPoint(*location),
             'created_dttm': datetime.utcnow(),
         }
     )
-    db.put(task)
     return task
 
 
-def refresh_members():
-    """Delete members from the datastore that have not updated their location today.
-    Populate local members dictionary with current info from the datastore.
+def db_save_nearby_results(token, username, results):
+    """Store the results of a nearby search for the page buttons, which may reach another instance.
+    Args:
+        token: the random key of the results.
+        username: the member who searched.
+        results: the (member name, distance in km) pairs, closest first.
+    Returns:
+        None; output is written to Stackdriver Logging.
+    """
+    logger.debug("In db_save_nearby_results handler.")
+    db = get_db()
+    task = db.entity(db.key('NearbyResults', token), exclude_from_indexes=('username', 'results',))
+    task.update({'username': username, 'results': json.dumps(results), 'created_dttm': datetime.utcnow()})
+    with span('datastore.put', kind='NearbyResults'):
+        db.put(task)
+
+
+def db_load_nearby_results(token):
+    """Load the results of a nearby search stored by db_save_nearby_results().
+    Args:
+        token: the random key of the results.
+    Returns:
+        A (username, [(member name, distance in km), ...]) pair, or None if the results are missing or older than
+        NEARBY_RESULTS_TTL_SECONDS.
+    """
+    logger.debug("In db_load_nearby_results handler.")
+    task = db_get_entity('NearbyResults', token)
+    if task is None or \
+            (datetime.utcnow() - utc_naive(task['created_dttm'])).total_seconds() >= NEARBY_RESULTS_TTL_SECONDS:
+        return None
+    return task['username'], [(username, distance_km) for username, distance_km in json.loads(task['results'])]
+
+
+def db_claim_update(update_id):
+    """Record in the datastore that an update is being handled.
+    Args:
+        update_id: the update_id of the Telegram update.
+    Returns:
+        True if no instance has recorded the update before.
+    """
+    logger.debug("In db_claim_update handler.")
+    db = get_db()
+    task = db.entity(db.key('ProcessedUpdate', str(update_id)))
+    task.update({'created_dttm': datetime.utcnow()})
+    with span('datastore.add_if_absent', kind='ProcessedUpdate'):
+        return db.add_if_absent(task)
+
+
+def db_release_update(update_id):
+    """Forget that an update was handled, so that its re-delivery is handled again.
+    Args:
+        update_id: the update_id of the Telegram update.
     Returns:
         None; output is written to Stackdriver Logging.
     """
-    logger.info("In refresh_members handler.")
-    global members
-    members = {}
-    member_entities = db_query_by_kind('Member')
+    logger.debug("In db_release_update handler.")
+    db_delete_keys([get_db().key('ProcessedUpdate', str(update_id))])
+
+
+def notification_key(recipient, neighbour):
+    """Build the key of the notification telling a member about a neighbour. There is one per pair, so a repeated
+    notification overwrites the previous one.
+    Args:
+        recipient: the member to notify.
+        neighbour: the member who is nearby.
+    Returns:
+        The Notification key.
+    """
+    # Telegram usernames cannot contain a colon
+    return get_db().key('Notification', '{}:{}'.format(recipient, neighbour))
+
+
+def db_enqueue_notifications(neighbour, selected_org, recipients):
+    """Write the notifications about a neighbour to the outbox, for the members who opted in with /notify and were
+    not told about the neighbour within NOTIFY_DEDUPE_SECONDS.
+    Args:
+        neighbour: the member who shared their location.
+        selected_org: the org of the neighbour.
+        recipients: a list of (member name, distance in km) pairs.
+    Returns:
+        The number of enqueued notifications.
+    """
+    logger.debug("In db_enqueue_notifications handler.")
+    db = get_db()
+    subscriber_keys = [db.key('Subscriber', username) for username, _ in recipients]
+    notification_keys = [notification_key(username, neighbour) for username, _ in recipients]
+    # One lookup for the opt-ins and the previous notifications
+    with span('datastore.get_multi', kind='Subscriber,Notification'):
+        found = {entity.key.flat_path: entity for entity in db.get_multi(subscriber_keys + notification_keys)}
+
     current_datetime = datetime.utcnow()
-    entity_keys_for_deletion = []
-    for member_entity in member_entities:
-        if member_entity['created_dttm'].day == current_datetime.day:
-            members[member_entity.key.name] = {}
-            members[member_entity.key.name]['selected_org'] = member_entity['selected_org']
-            members[member_entity.key.name]['travel_radius'] = member_entity['travel_radius']
-            members[member_entity.key.name]['location'] = {
-                'longitude': member_entity['location'].to_protobuf().longitude,
-                'latitude': member_entity['location'].to_protobuf().latitude,
+    notifications = []
+    for (username, distance_km), subscriber_key, key in zip(recipients, subscriber_keys, notification_keys):
+        subscriber = found.get(subscriber_key.flat_path)
+        if subscriber is None or not subscriber.get('enabled', True):
+            continue
+        previous = found.get(key.flat_path)
+        if previous is not None and \
+                (current_datetime - utc_naive(previous['created_dttm'])).total_seconds() < NOTIFY_DEDUPE_SECONDS:
+            continue
+        task = db.entity(key, exclude_from_indexes=('chat_id', 'text',))
+        task.update(
+            {
+                'chat_id': subscriber['chat_id'],
+                'text': '@{} from {} is {:.1f} km from you. Share your location to see everyone nearby.'.format(
+                    neighbour, selected_org, distance_km),
+                'pending': True,
+                'created_dttm': current_datetime,
             }
-        else:
-            # Add records from previous day or older for deletion
-            entity_keys_for_deletion.append(db.key('Member', member_entity.key.name))
+        )
+        notifications.append(task)
+    if notifications:
+        with span('datastore.put_multi', kind='Notification'):
+            db.put_multi(notifications)
+    return len(notifications)
+
+
+def db_upsert_members(member_entities):
+    """Upsert a batch of members with put_multi.
+    Args:
+        member_entities: the Member entities to upsert.
+    Returns:
+        The number of upserted members.
+    """
+    logger.debug("In db_upsert_members handler.")
+    return db_run_in_chunks(get_db().put_multi, member_entities)
+
 
-    if len(entity_keys_for_deletion) > 0:
-        db.delete_multi(entity_keys_for_deletion)
+def utc_naive(value):
+    """Convert a datetime to a naive UTC datetime, the way datetime.utcnow() returns it.
+    Args:
+        value: a naive UTC or a timezone aware datetime, e.g. one read from the datastore.
+    Returns:
+        The naive UTC datetime.
+    """
+    if value.tzinfo is None:
+        return value
+    return value.astimezone(timezone.utc).replace(tzinfo=None)
 
 
-def refresh_organizations():
-    """Ensure only authorized orgs are in the datastore. Sync the organizations dictionary of the current instance
-    with the datastore to populate members. If an organization is authorized,
+def member_from_entity(member_entity, store, index):
+    """Put a Member entity from the datastore into a members store and a spatial index.
+    Args:
+        member_entity: the Member entity.
+        store: the MemberStore.
+        index: the GeoGridIndex.
+    Returns:
+        None; output is written to Stackdriver Logging.
+    """
+    username = member_entity.key.name
+    if username in pending_member_writes:
+        # The local changes are newer, they will overwrite the entity when they are flushed
+        return
+    location = member_entity['location']
+    load_member(username, member_entity['selected_org'], member_entity['travel_radius'],
+                location.latitude, location.longitude, utc_naive(member_entity['created_dttm']), store, index)
+
+
+def load_member(username, selected_org, travel_radius, latitude, longitude, created_dttm, store, index):
+    """Put a member as stored in the datastore into a members store and a spatial index.
+    Args:
+        username: member name.
+        selected_org, travel_radius, latitude, longitude: the preferences and location of the member.
+        created_dttm: the naive UTC datetime of the last write of the member.
+        store: the MemberStore, members or a new one being loaded.
+        index: the GeoGridIndex of the store.
+    Returns:
+        None; output is written to Stackdriver Logging.
+    """
+    store.set(username, selected_org=selected_org, travel_radius=travel_radius, latitude=latitude,
+              longitude=longitude, created_dttm=created_dttm)
+    index.update(username, latitude, longitude)
+    store.mark_persisted(username)
+
+
+def refresh_members(changed_since=None):
+    """Populate local members dictionary with current info from the datastore.
+    Members that have not updated their location today are skipped; sweep_expired() deletes them.
+    Args:
+        changed_since: Optional. If set, only merge the members updated since this UTC datetime into the local
+            members dictionary, and drop the local members that expired, instead of a full reload.
+    Returns:
+        None; output is written to Stackdriver Logging.
+    """
+    logger.debug("In refresh_members handler.")
+    current_datetime = datetime.utcnow()
+    if changed_since:
+        member_entities = db_query_by_kind('Member', changed_since=changed_since)
+        with members_lock:
+            for member_entity in member_entities:
+                if utc_naive(member_entity['created_dttm']).date() == current_datetime.date():
+                    member_from_entity(member_entity, members, members_index)
+            for username in members:
+                created_dttm = members.created_dttm(username)
+                if created_dttm is not None and created_dttm.date() != current_datetime.date() \
+                        and username not in pending_member_writes:
+                    members.remove(username)
+                    members_index.remove(username)
+        return
+
+    # The handlers keep using the current members while the new ones load
+    new_members, new_index = MemberStore(), GeoGridIndex()
+    # Records from previous day or older are waiting for the sweeper, only load the ones written today
+    start_of_day = current_datetime.replace(hour=0, minute=0, second=0, microsecond=0)
+    member_entities = db_query_by_kind('Member', changed_since=start_of_day - timedelta(microseconds=1))
+    for member_entity in member_entities:
+        member_from_entity(member_entity, new_members, new_index)
+    swap_local_members(new_members, new_index)
+
+
+def swap_local_members(new_members, new_index):
+    """Replace the members store and the spatial index with fully loaded ones in one step. The local members the
+    new store may be missing or have older values of are carried over: the members with changes that have not been
+    written yet, and the members this instance wrote after the new store was read.
+    Args:
+        new_members: the new MemberStore.
+        new_index: the GeoGridIndex of the new members.
+    Returns:
+        None; output is written to Stackdriver Logging.
+    """
+    global members, members_index
+
+    today = datetime.utcnow().date()
+    with members_lock:
+        for username in members:
+            if username not in pending_member_writes and members.is_persisted(username):
+                created_dttm = members.created_dttm(username)
+                if created_dttm is None or created_dttm.date() != today:
+                    continue
+                if username in new_members and new_members.created_dttm(username) >= created_dttm:
+                    continue
+            new_members.copy_member(members, username)
+            location = new_members.location(username)
+            if location is not None:
+                new_index.update(username, *location)
+            else:
+                new_index.remove(username)
+        members, members_index = new_members, new_index
+
+
+def refresh_organizations(changed_since=None):
+    """Sync the organizations dictionary of the current instance with the datastore to populate members.
+    Orgs that are no longer authorized are skipped; sweep_expired() deletes them. If an organization is authorized,
     but is not in the datastore (has no members yet), add it to the organizations dictionary of the instance.
+    Args:
+        changed_since: Optional. If set, only merge the organizations updated since this UTC datetime into the local
+            organizations dictionary instead of a full reload.
     Returns:
         None; output is written to Stackdriver Logging.
     """
-    logger.info("In update_organizations_from_db handler.")
+    logger.debug("In update_organizations_from_db handler.")
 
-    global organizations
-    organizations = {}
-    organizations = defaultdict(list)
+    global organizations, user_orgs
 
     # Orgs currently authorized to use the bot. Uppercase the string first and then split into an array
     authorized_orgs = os.environ["AUTHORIZED_ORGS"].upper().split(',')
-    organization_entities = db_query_by_kind('Organization')
-    entity_keys_for_deletion = []
-    for org_entity in organization_entities:
-        if org_entity.key.name in authorized_orgs:
-            organizations[org_entity.key.name] = org_entity['members']
-        else:
-            # Add no longer authorized orgs for deletion
-            entity_keys_for_deletion.append(db.key('Organization', org_entity.key.name))
+    if changed_since:
+        for membership in db_query_by_kind('Membership', changed_since=changed_since):
+            add_local_membership(membership.key.parent.name, membership.key.name, authorized_orgs)
+        return
+
+    # The handlers keep using the current organizations while the new ones load
+    new_organizations, new_user_orgs = build_organizations(db_query_memberships(), authorized_orgs)
+    with organizations_lock:
+        organizations, user_orgs = new_organizations, new_user_orgs
+
+
+def build_organizations(memberships, authorized_orgs):
+    """Build an organizations dictionary and its reverse index.
+    Args:
+        memberships: (org_code, username) pairs.
+        authorized_orgs: orgs currently authorized to use the bot, the others are skipped.
+    Returns:
+        The organizations and user_orgs dictionaries.
+    """
+    new_organizations = defaultdict(set)
+    new_user_orgs = defaultdict(set)
+    for org_code, username in memberships:
+        if org_code in authorized_orgs:
+            new_organizations[org_code].add(username)
+            new_user_orgs[username].add(org_code)
+    add_authorized_orgs(new_organizations, authorized_orgs)
+    return new_organizations, new_user_orgs
+
+
+def db_query_memberships():
+    """Iterate over all the memberships in the datastore.
+    Returns:
+        An iterator of (org_code, username) pairs.
+    """
+    # Organizations that have not been migrated yet keep their members in the legacy 'members' list
+    for org_entity in db_query_by_kind('Organization'):
+        for username in org_entity.get('members') or []:
+            yield org_entity.key.name, username
+    for membership in db_query_by_kind('Membership'):
+        yield membership.key.parent.name, membership.key.name
 
-    if len(entity_keys_for_deletion) > 0:
-        db.delete_multi(entity_keys_for_deletion)
 
-    # Ensure all the authorized orgs are in the organizations variable.
-    # As soon as a member joins a new org, the datastore will be updated and the org will be in the datastore too.
-    if len(organizations) < len(authorized_orgs):
+def add_authorized_orgs(orgs, authorized_orgs):
+    """Ensure all the authorized orgs are in an organizations dictionary.
+    As soon as a member joins a new org, the datastore will be updated and the org will be in the datastore too.
+    Args:
+        orgs: the organizations dictionary.
+        authorized_orgs: orgs currently authorized to use the bot.
+    Returns:
+        None; output is written to Stackdriver Logging.
+    """
+    if len(orgs) < len(authorized_orgs):
         for org_code in authorized_orgs:
-            if org_code not in organizations:
-                organizations[org_code] = []
+            if org_code not in orgs:
+                orgs[org_code] = set()
+
+
+def add_local_membership(org_code, username, authorized_orgs):
+    """Add a member to an authorized organization in the organizations dictionary of the current instance.
+    Args:
+        org_code: organization name.
+        username: member name.
+        authorized_orgs: orgs currently authorized to use the bot.
+    Returns:
+        None; output is written to Stackdriver Logging.
+    """
+    if org_code in authorized_orgs:
+        with organizations_lock:
+            organizations[org_code].add(username)
+            user_orgs[username].add(org_code)
+
+
+def sync_instance_state():
+    """Sync the organizations and members dictionaries of the current instance with the datastore.
+    A full reload happens on a cold instance and every FULL_SYNC_TTL_SECONDS. Otherwise only the entities
+    changed since the previous sync are fetched.
+    Returns:
+        None; output is written to Stackdriver Logging.
+    """
+    # Concurrent handlers of a long running server sync one at a time
+    with sync_lock:
+        sync_started = datetime.utcnow()
+        full_sync_dttm = sync_state['full_sync_dttm']
+        if full_sync_dttm is None and SNAPSHOT_WARMUP:
+            snapshot_dttm = load_snapshot()
+            if snapshot_dttm is not None:
+                # The snapshot stands for a full sync at the time it was built, fetch what changed since then
+                full_sync_dttm = sync_state['full_sync_dttm'] = snapshot_dttm
+                sync_state['org_watermark'] = sync_state['member_watermark'] = snapshot_dttm - SYNC_WATERMARK_OVERLAP
+        if full_sync_dttm is None or (sync_started - full_sync_dttm).total_seconds() >= FULL_SYNC_TTL_SECONDS:
+            logger.info("Full sync of organizations and members")
+            refresh_organizations()
+            refresh_members()
+            refresh_subscribers()
+            sync_state['full_sync_dttm'] = sync_started
+        else:
+            logger.debug("Incremental sync of organizations and members")
+            refresh_organizations(changed_since=sync_state['org_watermark'])
+            refresh_members(changed_since=sync_state['member_watermark'])
+            # The snapshot does not hold the subscribers, an instance warmed up from it loads them all once
+            refresh_subscribers(changed_since=sync_state['subscriber_watermark'])
+
+        # Anything written after this point will be fetched by the next incremental sync
+        watermark = sync_started - SYNC_WATERMARK_OVERLAP
+        sync_state['org_watermark'] = watermark
+        sync_state['member_watermark'] = watermark
+        sync_state['subscriber_watermark'] = watermark
+
+
+def refresh_subscribers(changed_since=None):
+    """Sync the subscribers set of the current instance with the datastore.
+    Args:
+        changed_since: Optional. If set, only apply the opt-ins and opt-outs since this UTC datetime instead of
+            a full reload.
+    Returns:
+        None; output is written to Stackdriver Logging.
+    """
+    logger.debug("In refresh_subscribers handler.")
+    global subscribers
+
+    subscriber_entities = db_query_by_kind('Subscriber', changed_since=changed_since)
+    if changed_since:
+        for subscriber in subscriber_entities:
+            if subscriber.get('enabled', True):
+                subscribers.add(subscriber.key.name)
+            else:
+                subscribers.discard(subscriber.key.name)
+        return
+    subscribers = {subscriber.key.name for subscriber in subscriber_entities if subscriber.get('enabled', True)}
+
+
+def load_snapshot():
+    """Load the organizations and members of the current instance from the snapshot written by build_snapshot().
+    Returns:
+        The UTC datetime the snapshot was built, or None if there is no usable snapshot.
+    """
+    from snapshot import SnapshotError, decode_snapshot
+    global organizations, user_orgs
+
+    blob = db_read_snapshot()
+    if blob is None:
+        logger.info("No snapshot to warm up from")
+        return None
+    try:
+        snapshot = decode_snapshot(blob)
+    except SnapshotError as error:
+        logger.warning("Ignoring the snapshot: %s", error)
+        return None
+    current_datetime = datetime.utcnow()
+    if (current_datetime - snapshot.created_dttm).total_seconds() >= FULL_SYNC_TTL_SECONDS:
+        logger.info("Ignoring the snapshot of %s, it is older than a full sync", snapshot.created_dttm)
+        return None
+
+    authorized_orgs = os.environ["AUTHORIZED_ORGS"].upper().split(',')
+    new_organizations, new_user_orgs = build_organizations(snapshot.memberships, authorized_orgs)
+    with organizations_lock:
+        organizations, user_orgs = new_organizations, new_user_orgs
+    new_members, new_index = MemberStore(), GeoGridIndex()
+    for username, selected_org, travel_radius, latitude, longitude, created_dttm in snapshot.members:
+        # Members written before today are waiting for the sweeper, local changes are newer than the snapshot
+        if created_dttm.date() == current_datetime.date() and username not in pending_member_writes:
+            load_member(username, selected_org, travel_radius, latitude, longitude, created_dttm,
+                        new_members, new_index)
+    swap_local_members(new_members, new_index)
+    logger.info("Warmed up from the snapshot of %s: %d memberships, %d members", snapshot.created_dttm,
+                len(snapshot.memberships), len(snapshot.members))
+    return snapshot.created_dttm
+
+
+def db_read_snapshot():
+    """Read the snapshot blob. A snapshot that fits in one entity takes a single get.
+    Returns:
+        The blob, or None if there is no snapshot or its chunks were replaced while reading.
+    """
+    logger.debug("In db_read_snapshot handler.")
+    db = get_db()
+    with span('datastore.get', kind='Snapshot'):
+        head = db.get(db.key('Snapshot', 'current'))
+    if head is None:
+        return None
+    chunks = [head['data']]
+    if head['chunks'] > 1:
+        keys = [db.key('Snapshot', '{}.{}'.format(head['generation'], index)) for index in range(1, head['chunks'])]
+        with span('datastore.get_multi', kind='Snapshot'):
+            found = {entity.key.name: entity['data'] for entity in db.get_multi(keys)}
+        if len(found) != len(keys):
+            return None
+        chunks.extend(found[key.name] for key in keys)
+    return b''.join(chunks)
+
+
+def build_snapshot(request):
+    """Build the warm-up snapshot of the organizations and today's members, meant to be called on a schedule
+    (e.g. every few minutes by Cloud Scheduler, more often than FULL_SYNC_TTL_SECONDS).
+    Args:
+        request: A flask.Request object. <http://flask.pocoo.org/docs/1.0/api/#flask.Request>
+    Returns:
+        Response text with the size of the snapshot.
+    """
+    logger.debug("In build_snapshot handler")
+    from snapshot import Snapshot, encode_snapshot, split_blob
+
+    # Entities written while the snapshot is built are fetched by the incremental sync after loading it
+    created_dttm = datetime.utcnow()
+    authorized_orgs = os.environ["AUTHORIZED_ORGS"].upper().split(',')
+    memberships = sorted({(org_code, username) for org_code, username in db_query_memberships()
+                          if org_code in authorized_orgs})
+    start_of_day = created_dttm.replace(hour=0, minute=0, second=0, microsecond=0)
+    snapshot_members = [(member_entity.key.name, member_entity['selected_org'], member_entity['travel_radius'],
+                         member_entity['location'].latitude, member_entity['location'].longitude,
+                         utc_naive(member_entity['created_dttm']))
+                        for member_entity in db_query_by_kind('Member',
+                                                              changed_since=start_of_day - timedelta(microseconds=1))]
+    blob = encode_snapshot(Snapshot(created_dttm, memberships, snapshot_members))
+
+    # The chunks of a generation are written before the head that points to them, so readers never mix generations
+    db = get_db()
+    chunks = split_blob(blob, SNAPSHOT_CHUNK_BYTES)
+    generation = created_dttm.strftime('%Y%m%d%H%M%S%f')
+    previous = db.get(db.key('Snapshot', 'current'))
+    chunk_entities = []
+    for index, chunk in enumerate(chunks[1:], 1):
+        task = db.entity(db.key('Snapshot', '{}.{}'.format(generation, index)), exclude_from_indexes=('data',))
+        task.update({'data': chunk, 'created_dttm': created_dttm})
+        chunk_entities.append(task)
+    db_run_in_chunks(db.put_multi, chunk_entities)
+    head = db.entity(db.key('Snapshot', 'current'), exclude_from_indexes=('data',))
+    head.update({'data': chunks[0], 'chunks': len(chunks), 'generation': generation, 'created_dttm': created_dttm})
+    with span('datastore.put', kind='Snapshot'):
+        db.put(head)
+    if previous is not None and previous['chunks'] > 1:
+        db_delete_keys([db.key('Snapshot', '{}.{}'.format(previous['generation'], index))
+                        for index in range(1, previous['chunks'])])
+
+    logger.info('Built a snapshot of {} memberships and {} members: {} bytes in {} entities'.format(
+        len(memberships), len(snapshot_members), len(blob), len(chunks)))
+    return 'Built a snapshot of {} memberships and {} members: {} bytes in {} entities'.format(
+        len(memberships), len(snapshot_members), len(blob), len(chunks))
+
+
+def sweep_expired(request):
+    """Expiry sweeper for the datastore, meant to be called on a schedule (e.g. by Cloud Scheduler).
+    Deletes the members that have not updated their location today and the orgs that are no longer authorized,
+    so the webhook never pays for garbage collection.
+    Args:
+        request: A flask.Request object. <http://flask.pocoo.org/docs/1.0/api/#flask.Request>
+    Returns:
+        Response text with the number of deleted entities.
+    """
+    logger.debug("In sweep_expired handler")
+
+    # Members are kept until the end of the UTC day they last updated their location
+    cutoff = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
+    deleted_members = db_delete_keys(db_query_keys('Member', created_before=cutoff))
+
+    authorized_orgs = os.environ["AUTHORIZED_ORGS"].upper().split(',')
+    deleted_orgs = db_delete_keys([key for key in db_query_keys('Organization') if key.name not in authorized_orgs])
+    deleted_memberships = db_delete_keys([key for key in db_query_keys('Membership')
+                                          if key.parent.name not in authorized_orgs])
+
+    # Notifications are only kept to skip repeats within the dedupe window
+    notify_cutoff = datetime.utcnow() - timedelta(seconds=NOTIFY_DEDUPE_SECONDS)
+    deleted_notifications = db_delete_keys(db_query_keys('Notification', created_before=notify_cutoff))
+
+    # Nearby results are only needed while their page buttons work
+    results_cutoff = datetime.utcnow() - timedelta(seconds=NEARBY_RESULTS_TTL_SECONDS)
+    deleted_results = db_delete_keys(db_query_keys('NearbyResults', created_before=results_cutoff))
+
+    # Update ids are only needed while Telegram may re-deliver the update
+    dedupe_cutoff = datetime.utcnow() - timedelta(seconds=DEDUPE_TTL_SECONDS)
+    deleted_updates = db_delete_keys(db_query_keys('ProcessedUpdate', created_before=dedupe_cutoff))
+
+    active_members = db_count_by_kind('Member')
+    logger.info('Swept {} members, {} organizations, {} memberships, {} notifications, {} nearby results and {} '
+                'update ids. {} active members left'.format(deleted_members, deleted_orgs, deleted_memberships,
+                                                            deleted_notifications, deleted_results, deleted_updates,
+                                                            active_members))
+    return 'Deleted {} members, {} organizations, {} memberships, {} notifications, {} nearby results, {} update ' \
+           'ids. {} active members left'.format(deleted_members, deleted_orgs, deleted_memberships,
+                                                deleted_notifications, deleted_results, deleted_updates,
+                                                active_members)
+
+
+def deliver_notifications(request):
+    """Send the pending "someone is nearby" notifications within the Telegram rate limits, meant to be called
+    on a schedule (e.g. every minute by Cloud Scheduler). It stops after NOTIFY_DELIVERY_SECONDS; whatever is
+    left is sent by the next call.
+    Args:
+        request: A flask.Request object. <http://flask.pocoo.org/docs/1.0/api/#flask.Request>
+    Returns:
+        Response text with the number of delivered and failed notifications.
+    """
+    logger.debug("In deliver_notifications handler")
+    from itertools import islice
+    from notifications import DeliveryQueue
+
+    db = get_db()
+    telegram_client = get_telegram_client()
+    queue = DeliveryQueue(
+        lambda notification: telegram_client.call('send_message', chat_id=notification['chat_id'],
+                                                  text=notification['text']),
+        global_rate=TELEGRAM_GLOBAL_RATE, chat_rate=TELEGRAM_CHAT_RATE)
+    deadline = time.monotonic() + NOTIFY_DELIVERY_SECONDS
+    delivered_count, failed_count, left_over_count = 0, 0, 0
+    while time.monotonic() < deadline:
+        with span('datastore.query', kind='Notification'):
+            batch = list(islice(db.query('Notification', filters=[('pending', '=', True)]), NOTIFY_BATCH_SIZE))
+        if not batch:
+            break
+        delivered, failed, left_over = queue.deliver(batch, deadline)
+        sent_dttm = datetime.utcnow()
+        for notification in delivered:
+            notification.update({'pending': False, 'sent_dttm': sent_dttm})
+        for notification, error in failed:
+            notification.update({'pending': False, 'error': str(error)})
+        if delivered or failed:
+            with span('datastore.put_multi', kind='Notification'):
+                db.put_multi(delivered + [notification for notification, _ in failed])
+        delivered_count += len(delivered)
+        failed_count += len(failed)
+        left_over_count = len(left_over)
+
+    logger.info('Delivered {} notifications, {} failed, {} left for the next run'.format(
+        delivered_count, failed_count, left_over_count))
+    return 'Delivered {} notifications, {} failed, {} left for the next run'.format(
+        delivered_count, failed_count, left_over_count)
+
+
+def migrate_memberships(request):
+    """One-off migration of the legacy Organization 'members' lists to Membership entities.
+    It is safe to run several times: the memberships are upserted and an org is only rewritten without
+    its 'members' list after all of its memberships are stored.
+    Args:
+        request: A flask.Request object. <http://flask.pocoo.org/docs/1.0/api/#flask.Request>
+    Returns:
+        Response text with the number of migrated memberships.
+    """
+    logger.debug("In migrate_memberships handler")
+    migrated_orgs = 0
+    migrated_memberships = 0
+    for org_entity in db_query_by_kind('Organization'):
+        if 'members' not in org_entity:
+            continue
+        created_dttm = org_entity.get('created_dttm')
+        memberships = [membership_entity(org_entity.key.name, username, created_dttm)
+                       for username in set(org_entity['members'])]
+        migrated_memberships += db_run_in_chunks(get_db().put_multi, memberships)
+        del org_entity['members']
+        with span('datastore.put', kind='Organization'):
+            get_db().put(org_entity)
+        migrated_orgs += 1
+
+    logger.info('Migrated {} memberships of {} organizations'.format(migrated_memberships, migrated_orgs))
+    return 'Migrated {} memberships of {} organizations'.format(migrated_memberships, migrated_orgs)
 
 
 def add_new_user(update):
@@ -194,27 +1020,29 @@ def add_new_user(update):
     Returns:
         None; output is written to Stackdriver Logging.
     """
-    logger.info("In addNewUser handler.")
+    logger.debug("In addNewUser handler.")
     # Check whether the user entered a correct name of an organization
     selected_org = update.message.text.upper()
     username = update.message.from_user.username
     if not username:
-        update.message.reply_text('Users must have a username to use this bot. Please update your telegram'
-                                  ' profile and retry. To get help use /help command. To start again when ready use'
-                                  ' /start.')
+        reply_text(update, 'Users must have a username to use this bot. Please update your telegram'
+                           ' profile and retry. To get help use /help command. To start again when ready use'
+                           ' /start.')
         return
     if selected_org in organizations:
         logger.info("Adding current user to the organizations dictionary and the datastore")
-        # Adding current user to the organizations dictionary and the datastore
-        organizations[selected_org].append(username)
-        db_upsert_org(selected_org, organizations[selected_org])
+        # Adding current user to the organizations dictionaries and the datastore
+        with organizations_lock:
+            organizations[selected_org].add(username)
+            user_orgs[username].add(selected_org)
+        db_add_membership(selected_org, username)
         # Adding current user to the members dictionary
         update_daily_active_user(username, selected_org=selected_org)
-        update.message.reply_text('You were added to the organization ' + selected_org)
+        reply_text(update, 'You were added to the organization ' + selected_org)
         build_distance_selector(update, selected_org)
     else:
         # Prompt user to enter their org name
-        update.message.reply_text('Hi! Please enter the name of your organization or group:')
+        reply_text(update, 'Hi! Please enter the name of your organization or group:')
 
 
 def update_daily_active_user(username, selected_org=None, travel_radius=None, location=None):
@@ -227,26 +1055,92 @@ def update_daily_active_user(username, selected_org=None, travel_radius=None, lo
     Returns:
         None; output is written to Stackdriver Logging.
     """
-    if username:
-        if username not in members:
-            members[username] = {}
-        if selected_org:
-            members[username]['selected_org'] = selected_org
-        if travel_radius:
-            members[username]['travel_radius'] = travel_radius
-        if location:
-            members[username]['location'] = location
-    else:
+    if not username:
         logger.error('Required field "username" is missing')
+        return
 
-    if 'selected_org' in members[username] and 'travel_radius' in members[username] and 'location' in members[username]:
-        # Adding current user to the members datastore
-        db_upsert_member(
-            username,
-            members[username]['selected_org'],
-            members[username]['travel_radius'],
-            members[username]['location']
-        )
+    with members_lock:
+        members.set(username, selected_org=selected_org or None, travel_radius=travel_radius or None)
+        if location:
+            members.set(username, latitude=location['latitude'], longitude=location['longitude'])
+            members_index.update(username, location['latitude'], location['longitude'])
+
+        if members.is_complete(username):
+            # Adding current user to the members datastore, coalesced with the other changes of the update
+            if member_write_needed(username):
+                with pending_member_writes_lock:
+                    pending_member_writes.add(username)
+
+
+def member_write_needed(username):
+    """Check whether the changes of a member have to be written to the datastore.
+    Args:
+        username: member name.
+    Returns:
+        True or False.
+    """
+    persisted = members.persisted(username)
+    if persisted is None:
+        return True
+    selected_org, travel_radius, latitude, longitude, created_dttm = persisted
+    if members.selected_org(username) != selected_org or members.travel_radius(username) != travel_radius:
+        return True
+    # Members expire at the end of the UTC day of their last write
+    if created_dttm.date() != datetime.utcnow().date():
+        return True
+    moved_km = haversine_distance(latitude, longitude, *members.location(username))
+    return moved_km >= MEMBER_WRITE_MIN_MOVE_KM
+
+
+def flush_member_writes():
+    """Write the buffered member changes to the datastore in one batch.
+    Returns:
+        The number of written members.
+    """
+    with members_lock:
+        with pending_member_writes_lock:
+            usernames = list(pending_member_writes)
+            pending_member_writes.clear()
+        if not usernames:
+            return 0
+        entities = [member_entity(username,
+                                  members.selected_org(username),
+                                  members.travel_radius(username),
+                                  members.location(username)) for username in usernames if username in members]
+    try:
+        db_upsert_members(entities)
+    except Exception:
+        # Keep the changes for the next flush
+        with pending_member_writes_lock:
+            pending_member_writes.update(usernames)
+        raise
+    with members_lock:
+        for entity in entities:
+            # A full sync may have swapped in a store without the member
+            if entity.key.name in members:
+                members.set(entity.key.name, created_dttm=entity['created_dttm'])
+                members.mark_persisted(entity.key.name)
+    return len(entities)
+
+
+def start_member_write_flusher(interval_seconds):
+    """Flush the buffered member changes on a timer, for long running processes.
+    Args:
+        interval_seconds: the number of seconds between flushes.
+    Returns:
+        The daemon thread running the flushes.
+    """
+    def flush_periodically():
+        while True:
+            time.sleep(interval_seconds)
+            try:
+                flush_member_writes()
+            except Exception as error:
+                logger.error('Flushing member writes failed: %s', error)
+
+    flusher = threading.Thread(target=flush_periodically, name='member-write-flusher', daemon=True)
+    flusher.start()
+    return flusher
 
 
 def build_distance_selector(update, selected_org):
@@ -258,9 +1152,38 @@ def build_distance_selector(update, selected_org):
         None; output is written to Stackdriver Logging.
     """
 
-    # TODO: check if the radius is already defined in members[username]['travel_radius']
+    # TODO: check if the radius is already defined in members.travel_radius(username)
     # if so, let the user know the value and offer to continue, change radius, or change the selected org.
-    logger.info("In buildDistanceSelector handler")
+    logger.debug("In buildDistanceSelector handler")
+    if update.message:
+        username = update.message.from_user.username
+        reply_text(
+            update,
+            distance_selector_text(selected_org),
+            reply_markup=distance_selector_markup(len(user_orgs.get(username, ())) > 1),
+        )
+
+
+def distance_selector_text(selected_org):
+    """Build the text of the distance selector.
+    Args:
+        selected_org: the org selected by the current user.
+    Returns:
+        The message text.
+    """
+    return ("{} is your currently selected organization. "
+            "Please choose how far you are willing to travel:".format(selected_org))
+
+
+@lru_cache(maxsize=None)
+def distance_selector_markup(org_switcher=False):
+    """Build the inline keyboard of the distance selector. There are only two variants, so each is built once.
+    Args:
+        org_switcher: Optional. Add the "Change organization" button, for users in several orgs.
+    Returns:
+        The InlineKeyboardMarkup.
+    """
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
     keyboard = [
         [
             InlineKeyboardButton("1 km", callback_data='1'),
@@ -270,18 +1193,46 @@ def build_distance_selector(update, selected_org):
             InlineKeyboardButton("3 km", callback_data='3'),
             InlineKeyboardButton("4 km", callback_data='4'),
         ],
-        # TODO: In the future support multiple orgs per user and allow to switch the selected org
-        # [
-        #   InlineKeyboardButton("Change organization", callback_data='change_org'),
-        # [
     ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    if update.message:
-        update.message.reply_text(
-            "{} is your currently selected organization. "
-            "Please choose how far you are willing to travel:".format(selected_org),
-            reply_markup=reply_markup,
-        )
+    if org_switcher:
+        keyboard.append([InlineKeyboardButton("Change organization", callback_data='change_org')])
+    return InlineKeyboardMarkup(keyboard)
+
+
+@lru_cache(maxsize=256)
+def org_selector_markup(org_codes):
+    """Build the inline keyboard listing the orgs of a user. Users in the same orgs share it, so it is cached.
+    Args:
+        org_codes: a sorted tuple of org names.
+    Returns:
+        The InlineKeyboardMarkup.
+    """
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+    return InlineKeyboardMarkup([[InlineKeyboardButton(org_code, callback_data='org:' + org_code)]
+                                 for org_code in org_codes])
+
+
+@lru_cache(maxsize=None)
+def location_request_markup():
+    """Build the keyboard with the Send Location button. It is the same for everyone, so it is built once.
+    Returns:
+        The ReplyKeyboardMarkup.
+    """
+    from telegram import KeyboardButton, ReplyKeyboardMarkup
+    location_keyboard = KeyboardButton(text="Send Location", request_location=True)
+    custom_keyboard = [[location_keyboard]]
+    # Hidden once used, so the results can carry their own inline keyboard
+    return ReplyKeyboardMarkup(custom_keyboard, one_time_keyboard=True)
+
+
+@lru_cache(maxsize=None)
+def remove_keyboard_markup():
+    """Build the markup that hides the Send Location keyboard. It is built once.
+    Returns:
+        The ReplyKeyboardRemove.
+    """
+    from telegram import ReplyKeyboardRemove
+    return ReplyKeyboardRemove()
 
 
 def inline_keyboard_handler(update):
@@ -291,20 +1242,62 @@ def inline_keyboard_handler(update):
     Returns:
         None; output is written to Stackdriver Logging.
     """
-    logger.info("In button handler. Query data: " + str(update.callback_query.data))
+    logger.debug("In button handler. Query data: %s", update.callback_query.data)
     query = update.callback_query
 
     if query.data.isdigit():
         update_daily_active_user(query.from_user.username, travel_radius=query.data)
-        bot.edit_message_text(text="You selected {} km search radius".format(query.data),
-                              chat_id=query.message.chat_id,
-                              message_id=query.message.message_id)
-        bot.answer_callback_query(query.id)
+        # The calls below do not depend on each other, so they run concurrently
+        telegram_client = get_telegram_client()
+        telegram_client.submit('edit_message_text',
+                               text="You selected {} km search radius".format(query.data),
+                               chat_id=query.message.chat_id,
+                               message_id=query.message.message_id)
         request_location(update)
+    elif query.data == 'change_org':
+        orgs_of_user = tuple(sorted(user_orgs.get(query.from_user.username, ())))
+        telegram_client = get_telegram_client()
+        telegram_client.reply('edit_message_text',
+                              text="Please choose the organization:",
+                              chat_id=query.message.chat_id,
+                              message_id=query.message.message_id,
+                              reply_markup=org_selector_markup(orgs_of_user))
+    elif query.data.startswith('org:'):
+        select_org(update, query.data[len('org:'):])
+    elif query.data.startswith('more:'):
+        fields = query.data.split(':')
+        if len(fields) != 3 or not fields[1].isalnum() or not fields[2].isdigit():
+            logger.warning('Update "%s" caused error. Expected more:<token>:<page>, received "%s"', update, query.data)
+            return
+        show_nearby_page(update, fields[1], int(fields[2]))
     else:
         logger.warning('Update "%s" caused error. Expected a digit, received "%s"', update, query.data)
 
 
+def select_org(update, org_code):
+    """Switch the selected org of the current user and show the distance selector again.
+    Args:
+        update: an incoming Telegram update.
+        org_code: the org chosen on the org selector.
+    Returns:
+        None; output is written to Stackdriver Logging.
+    """
+    logger.debug("In select_org handler. Org: %s", org_code)
+    query = update.callback_query
+    username = query.from_user.username
+    telegram_client = get_telegram_client()
+    orgs_of_user = user_orgs.get(username, ())
+    if org_code not in orgs_of_user:
+        logger.warning('User "%s" is not a member of the org "%s"', username, org_code)
+        return
+    update_daily_active_user(username, selected_org=org_code)
+    telegram_client.reply('edit_message_text',
+                          text=distance_selector_text(org_code),
+                          chat_id=query.message.chat_id,
+                          message_id=query.message.message_id,
+                          reply_markup=distance_selector_markup(len(orgs_of_user) > 1))
+
+
 def request_location(update):
     """Request user location.
     Args:
@@ -312,11 +1305,10 @@ def request_location(update):
     Returns:
         None; output is written to Stackdriver Logging.
     """
-    logger.info("In request_location.")
-    location_keyboard = KeyboardButton(text="Send Location", request_location=True)
-    custom_keyboard = [[location_keyboard]]
-    reply_markup = ReplyKeyboardMarkup(custom_keyboard)
-    bot.send_message(
+    logger.debug("In request_location.")
+    reply_markup = location_request_markup()
+    get_telegram_client().reply(
+        'send_message',
         chat_id=update.callback_query.message.chat_id,
         text="Please share your location with me, so I can find the other org members nearby",
         reply_markup=reply_markup)
@@ -329,50 +1321,189 @@ def check_who_is_around(update):
     Returns:
         None; output is written to Stackdriver Logging.
     """
-    logger.info("In check_who_is_around")
+    logger.debug("In check_who_is_around")
+    from geo import nearest_within_radius
+
     current_username = update.message.from_user.username
-    current_user = members[current_username]
-    logger.info('Current user keys: ' + ', '.join(current_user.keys()))
-    selected_org = current_user['selected_org']
+    selected_org = members.selected_org(current_username)
+    travel_radius = members.travel_radius(current_username)
+    latitude, longitude = members.location(current_username)
     usernames_in_the_org = organizations[selected_org]
-    users_nearby = []
-
-    for username in usernames_in_the_org:
-        if username != current_username\
-                and username in members\
-                and compute_distance(current_user['location'], members[username]['location']) <= \
-                float(current_user['travel_radius']):
-            logger.info(username + 'is nearby')
-            users_nearby.append('@' + username)
-
-    reply_markup = ReplyKeyboardRemove()
-    if len(users_nearby) > 0:
-        update.message.reply_text(
-            'The following members are near you {}'.format(', '.join(users_nearby)),
-            reply_markup=reply_markup,
-        )
+    results = []
+
+    # Only the members in the grid cells around the current user can be within the travel radius
+    candidates = members_index.candidates(latitude, longitude, travel_radius)
+    with organizations_lock:
+        candidates &= usernames_in_the_org
+    candidate_usernames = [username for username in sorted(candidates)
+                           if username != current_username and username in members]
+    increment('nearby.org_members', len(usernames_in_the_org))
+    increment('nearby.candidates', len(candidate_usernames))
+    if candidate_usernames:
+        coordinates = members.coordinates(candidate_usernames)
+        nearest, match_count, exact_checks = nearest_within_radius(latitude, longitude, coordinates, travel_radius,
+                                                                   compute_point_distance, NEARBY_MAX_RESULTS)
+        increment('nearby.exact_checks', exact_checks)
+        increment('nearby.matches', match_count)
+        results = [(candidate_usernames[position], distance_km) for distance_km, position in nearest]
+        increment('nearby.notifications', notify_members_nearby(current_username,
+                                                                [username for username, _ in results]))
+
+    if len(results) > 0:
+        token = None
+        if len(results) > NEARBY_PAGE_SIZE:
+            # The other pages are served from the stored results, without scanning again
+            token = uuid.uuid4().hex[:12]
+            get_nearby_results().put(token, (current_username, results))
+            db_save_nearby_results(token, current_username, results)
+        text, reply_markup = nearby_page(results, 0, token)
+        reply_text(update, text, reply_markup=reply_markup or remove_keyboard_markup())
         # TODO: Here offer to send a group chat "Would you like to meet in an hour at ...
     else:
-        update.message.reply_text(
+        reply_text(
+            update,
             'Sorry, no one is around at this time. To get help use /help command. To start again use /start.',
-            reply_markup=reply_markup,
+            reply_markup=remove_keyboard_markup(),
         )
 
 
-def compute_distance(location_a, location_b):
-    """Computes distance between 2 locations in kilometers.
+def nearby_page(results, page, token=None):
+    """Build one page of the nearby search results.
+    Args:
+        results: the (member name, distance in km) pairs, closest first.
+        page: the page number, from 0.
+        token: Optional. The key of the results in the cache, needed for the page buttons.
+    Returns:
+        The message text and the InlineKeyboardMarkup with the page buttons, or None if there is one page.
+    """
+    first = page * NEARBY_PAGE_SIZE
+    users_nearby = ['@{} ({:.1f} km)'.format(username, distance_km)
+                    for username, distance_km in results[first:first + NEARBY_PAGE_SIZE]]
+    text = 'The following members are near you {}'.format(', '.join(users_nearby))
+    if token is None:
+        return text, None
+
+    from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+    text += '\nShowing {}-{} of {}, closest first.'.format(first + 1, first + len(users_nearby), len(results))
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("Previous", callback_data='more:{}:{}'.format(token, page - 1)))
+    if first + NEARBY_PAGE_SIZE < len(results):
+        buttons.append(InlineKeyboardButton("More", callback_data='more:{}:{}'.format(token, page + 1)))
+    return text, InlineKeyboardMarkup([buttons])
+
+
+def show_nearby_page(update, token, page):
+    """Show another page of cached nearby search results, handles the page buttons.
     Args:
-        location_a: GPS coordinates of the first location, e.g. {'longitude': 37.742, 'latitude': 55.45}
-        location_b: GPS coordinates of the second location, e.g. {'longitude': 33.742, 'latitude': 55.45}
+        update: an incoming Telegram update.
+        token: the key of the results in the cache.
+        page: the page number, from 0.
     Returns:
-        The distance between the locations in kilometers.
+        None; output is written to Stackdriver Logging.
     """
-    logger.info("In compute_distance.")
+    logger.debug("In show_nearby_page handler. Page: %d", page)
+    query = update.callback_query
+    telegram_client = get_telegram_client()
+    cached = get_nearby_results().get(token)
+    if cached is None:
+        # The search ran on another instance, or this one restarted
+        cached = db_load_nearby_results(token)
+        if cached is not None:
+            get_nearby_results().put(token, cached)
+    if cached is None or cached[0] != query.from_user.username or page * NEARBY_PAGE_SIZE >= len(cached[1]):
+        # Expired, swept, or not the results of this user
+        telegram_client.reply('edit_message_text',
+                              text='These results have expired. Please share your location again.',
+                              chat_id=query.message.chat_id,
+                              message_id=query.message.message_id)
+        return
+    _, results = cached
+    text, reply_markup = nearby_page(results, page, token)
+    telegram_client.reply('edit_message_text',
+                          text=text,
+                          chat_id=query.message.chat_id,
+                          message_id=query.message.message_id,
+                          reply_markup=reply_markup)
+
+
+def notify_members_nearby(current_username, usernames_nearby):
+    """Enqueue the notifications for the members near the current user, who are also within their own travel
+    radius. deliver_notifications() sends them, so the webhook does not wait for them.
+    Args:
+        current_username: the member who shared their location.
+        usernames_nearby: the members within the travel radius of the current user.
+    Returns:
+        The number of enqueued notifications.
+    """
+    location = members.location(current_username)
+    recipients = []
+    # Only the members who opted in need a datastore lookup
+    for username in (username for username in usernames_nearby if username in subscribers):
+        distance_km = haversine_distance(*location, *members.location(username))
+        travel_radius = members.travel_radius(username)
+        if travel_radius is not None and distance_km <= travel_radius:
+            recipients.append((username, distance_km))
+    if not recipients:
+        return 0
+    return db_enqueue_notifications(current_username, members.selected_org(current_username), recipients)
+
+
+def toggle_notifications(update):
+    """Turn the "someone is nearby" notifications of the current user on or off, handles the /notify command.
+    Args:
+        update: an incoming Telegram update.
+    Returns:
+        None; output is written to Stackdriver Logging.
+    """
+    logger.debug("In toggle_notifications handler")
+    username = update.message.from_user.username
+    if not username:
+        reply_text(update, 'Users must have a username to use this bot. Please update your telegram'
+                           ' profile and retry. To get help use /help command.')
+        return
+    db = get_db()
+    key = db.key('Subscriber', username)
+    with span('datastore.get', kind='Subscriber'):
+        subscriber = db.get(key)
+    enabled = subscriber is None or not subscriber.get('enabled', True)
+    task = db.entity(key, exclude_from_indexes=('chat_id',))
+    # created_dttm is the time of the last change, for the incremental syncs
+    task.update({'chat_id': update.message.chat_id, 'enabled': enabled, 'created_dttm': datetime.utcnow()})
+    with span('datastore.put', kind='Subscriber'):
+        db.put(task)
+    if not enabled:
+        subscribers.discard(username)
+        reply_text(update, 'Notifications are off. Use /notify to turn them on again.')
+        return
+    subscribers.add(username)
+    reply_text(update, 'Notifications are on. When an org member shares a location within your search radius, '
+                       'I will let you know. Use /notify again to turn them off.')
+
+
+def compute_point_distance(point_a, point_b):
+    """Computes the geodesic distance between 2 points in kilometers.
+    Args:
+        point_a: (latitude, longitude) of the first point, e.g. (55.45, 37.742)
+        point_b: (latitude, longitude) of the second point, e.g. (55.45, 33.742)
+    Returns:
+        The distance between the points in kilometers.
+    """
+    from geopy import distance
+    return distance.distance(point_a, point_b).km
 
-    loc_a = (location_a['longitude'], location_a['latitude'])
-    loc_b = (location_b['longitude'], location_b['latitude'])
 
-    return distance.distance(loc_a, loc_b).km
+def reply_text(update, text, reply_markup=None):
+    """Reply to the message of an update. Consecutive replies are sent in order,
+    the last one may be returned in the webhook response.
+    Args:
+        update: an incoming Telegram update.
+        text: the text of the reply.
+        reply_markup: Optional. The keyboard to show with the reply.
+    Returns:
+        None; output is written to Stackdriver Logging.
+    """
+    get_telegram_client().reply('send_message', chat_id=update.message.chat_id, text=text, reply_markup=reply_markup)
 
 
 def log_warning(update, warn_message):
@@ -383,7 +1514,7 @@ def log_warning(update, warn_message):
     Returns:
         None; output is written to Stackdriver Logging
     """
-    logger.info("In error handler")
+    logger.debug("In error handler")
     logger.warning('Update "%s" caused warning "%s"', update, warn_message)
 
 
@@ -395,7 +1526,7 @@ def log_error(update, error_message):
     Returns:
         None; output is written to Stackdriver Logging
     """
-    logger.info("In error handler")
+    logger.debug("In error handler")
     logger.error('Update "%s" caused error "%s"', update, error_message)
 
 
@@ -411,7 +1542,7 @@ def get_message_age(message):
         event_time = message.edit_date
     event_age = (datetime.now() - event_time).total_seconds()
     event_age_ms = event_age * 1000
-    logger.info(str(event_age_ms))
+    logger.debug('Message age %s ms', event_age_ms)
     return event_age_ms
 
 
@@ -442,14 +1573,16 @@ def bot_help(update):
     Returns:
         None; The output is written to Stackdriver Logging
     """
-    logger.info("In help handler")
+    logger.debug("In help handler")
     # TODO: Add instructions for delete user's data etc.
-    update.message.reply_text('Please use /start command to start or restart the bot.\n' 
-                              'We store the location information that you submitted for 24 hours maximum.\n'
-                              'If you would like to add your organization to We Meet Bot as a private one and use '
-                              'the bot for your needs, please contact @tigmir. Prices for private(closed) organizations'
-                              ' start at $5 per month per organization.\n' 
-                              'If you have any additional questions, please contact @tigmir.')
+    reply_text(update, 'Please use /start command to start or restart the bot.\n'
+                       'Use /notify to get a message when an org member shares a location near you, '
+                       'and again to stop.\n'
+                       'We store the location information that you submitted for 24 hours maximum.\n'
+                       'If you would like to add your organization to We Meet Bot as a private one and use '
+                       'the bot for your needs, please contact @tigmir. Prices for private(closed) organizations'
+                       ' start at $5 per month per organization.\n'
+                       'If you have any additional questions, please contact @tigmir.')
 
 
 def start(update):
@@ -459,26 +1592,23 @@ def start(update):
     Returns:
         None; The output is written to Stackdriver Logging
     """
-    logger.info("In start handler.")
+    logger.debug("In start handler.")
 
-    refresh_organizations()
-    refresh_members()
+    sync_instance_state()
 
-    # Check whether the user is already in the organization. One org for now.
-    # A different approach later, as loop is not practical when many orgs.
+    # The orgs of the user come from the reverse index, however many orgs there are
     username = update.message.from_user.username
-    # TODO: support multiple orgs instead of only the first one.
-    #  Below we need to find the first org, where this username is found. So, in the future, we will search among all
-    #  orgs. At present we have only one org {org_code}. Therefore, no need to loop among all.
-    org_code = list(organizations.keys())[0]
+    orgs_of_user = user_orgs.get(username)
     if username in members:
-        if members[username]['selected_org']:
-            build_distance_selector(update, members[username]['selected_org'])
+        if members.selected_org(username):
+            build_distance_selector(update, members.selected_org(username))
         else:
             logger.warning("Probably an error. User exists in the user dictionary, but without an org. " +
                            "Calling add_new_user() to rewrite")
             add_new_user(update)
-    elif username in organizations[org_code]:
+    elif orgs_of_user:
+        # Start with any of the orgs, the keyboard lets the user switch
+        org_code = min(orgs_of_user)
         update_daily_active_user(username, selected_org=org_code)
         build_distance_selector(update, org_code)
     else:
@@ -491,46 +1621,176 @@ def webhook(request):
     Args:
         request: A flask.Request object. <http://flask.pocoo.org/docs/1.0/api/#flask.Request>
     Returns:
-        Response text.
+        Response text, or a JSON Bot API call carrying the last reply to the update.
     """
 
-    logger.info("In webhook handler")
+    logger.debug("In webhook handler")
 
     if request.method == "POST":
-        update = Update.de_json(request.get_json(force=True), bot)
-
-        # your bot can receive updates without messages
-        if update.message:
-            if timeout(update, update.message):
-                return "Timeout"
-            bot.send_chat_action(chat_id=update.message.chat_id, action=ChatAction.TYPING)
-            # I need a switch() here!!
-            if update.message.text == "/start":
-                start(update)
-                return "ok"
-            if update.message.text == "/help":
-                bot_help(update)
-                return "ok"
-            if update.message.location:
-                update_daily_active_user(update.message.from_user.username, location=update.message.location)
-                check_who_is_around(update)
-                return "ok"
-
-            # default
-            add_new_user(update)
-            return "ok"
-
-        # Handle user inline keyboard events
-        if update.callback_query:
-            if timeout(update, update.callback_query.message):
-                return "Timeout"
-            bot.send_chat_action(chat_id=update.callback_query.message.chat_id, action=ChatAction.TYPING)
-            inline_keyboard_handler(update)
-            return "ok"
-
-        return "error"
+        return process_update(request.get_json(force=True))
     else:
         # Only POST accepted
         logger.warning("Only POST method accepted")
         return "error"
 
+
+def process_update(payload, flush_writes=True):
+    """Handle one update, the common part of webhook() and the long running server.
+    Args:
+        payload: the update as a dictionary decoded from JSON.
+        flush_writes: Optional. Write the buffered member changes before returning. A long running process
+            may flush them on a timer instead, see start_member_write_flusher().
+    Returns:
+        Response text, or a JSON Bot API call carrying the last reply to the update.
+    """
+    # Acknowledge re-delivered updates before doing any other work
+    update_id = payload.get('update_id')
+    if update_id is not None and not get_update_deduplicator().claim(update_id):
+        logger.info('Duplicate update %s acknowledged', update_id)
+        return "ok"
+
+    from telegram import Update
+    telegram_client = get_telegram_client()
+    trace = start_trace('update')
+    try:
+        if admit_update(payload):
+            update = Update.de_json(payload, telegram_client.bot)
+            trace.attributes.update(update_id=update.update_id, type=get_update_type(update))
+            with span('handler'):
+                response = handle_update(update)
+            # Cloud Functions may throttle the instance after the response, finish the writes and calls first
+            if flush_writes:
+                flush_member_writes()
+        else:
+            trace.attributes.update(update_id=update_id)
+            response = "Throttled"
+    except Exception:
+        # Let Telegram retry the update, even if the held reply cannot be sent
+        try:
+            telegram_client.flush_reply()
+        finally:
+            if update_id is not None:
+                get_update_deduplicator().release(update_id)
+        raise
+    finally:
+        telegram_client.wait_pending()
+        finish_trace()
+        report_cold_start()
+    payload = telegram_client.take_reply()
+    if payload:
+        return json.dumps(payload), 200, {'Content-Type': 'application/json'}
+    return response
+
+
+def admit_update(payload):
+    """Apply admission control to an update before it is parsed. The sender of a rejected update is told to try
+    again shortly, at most once every ADMISSION_NOTICE_SECONDS.
+    Args:
+        payload: the update as a dictionary decoded from JSON.
+    Returns:
+        True if the update should be handled.
+    """
+    if not ADMISSION_CONTROL:
+        return True
+    from admission import ADMITTED, DROPPED, classify_update
+
+    user, kind = classify_update(payload)
+    decision, notify = get_admission_controller().admit(user, kind)
+    if decision == ADMITTED:
+        return True
+    increment('admission.' + decision)
+    if notify:
+        logger.info('Update %s %s: %s of user %s', payload.get('update_id'), decision, kind, user)
+        if decision == DROPPED:
+            text = "You are sending messages too fast. Please try again in a few seconds."
+        else:
+            text = "The bot is busy right now. Please try again in a few seconds."
+        # Like every reply, it may ride on the webhook response
+        if kind == 'callback':
+            get_telegram_client().reply('answer_callback_query', callback_query_id=payload['callback_query']['id'],
+                                        text=text)
+        else:
+            get_telegram_client().reply('send_message', chat_id=payload['message']['chat']['id'], text=text)
+    return False
+
+
+def get_update_type(update):
+    """Classify an update for instrumentation.
+    Args:
+        update: an incoming Telegram update.
+    Returns:
+        'command', 'location', 'text', 'callback' or 'other'.
+    """
+    if update.message:
+        if update.message.location:
+            return 'location'
+        if update.message.text and update.message.text.startswith('/'):
+            return 'command'
+        return 'text'
+    if update.callback_query:
+        return 'callback'
+    return 'other'
+
+
+def report_cold_start():
+    """Log how long the cold start took, once per instance, after its first update.
+    Returns:
+        None; output is written to Stackdriver Logging.
+    """
+    if cold_start['first_update_done']:
+        return
+    cold_start['first_update_done'] = True
+    logger.info('Cold start: module import {:.1f} ms, import to the end of the first update {:.1f} ms'.format(
+        cold_start['import_seconds'] * 1000, (time.perf_counter() - IMPORT_STARTED) * 1000))
+
+
+def handle_update(update):
+    """Dispatch an incoming Telegram update to its handler.
+    Args:
+        update: an incoming Telegram update.
+    Returns:
+        Response text.
+    """
+    from telegram import ChatAction
+
+    # your bot can receive updates without messages
+    if update.message:
+        if timeout(update, update.message):
+            return "Timeout"
+        # The typing indicator is not critical, do not wait for it
+        get_telegram_client().submit('send_chat_action', chat_id=update.message.chat_id, action=ChatAction.TYPING)
+        # I need a switch() here!!
+        if update.message.text == "/start":
+            start(update)
+            return "ok"
+        if update.message.text == "/help":
+            bot_help(update)
+            return "ok"
+        if update.message.text == "/notify":
+            toggle_notifications(update)
+            return "ok"
+        if update.message.location:
+            update_daily_active_user(update.message.from_user.username, location=update.message.location)
+            check_who_is_around(update)
+            return "ok"
+
+        # default
+        add_new_user(update)
+        return "ok"
+
+    # Handle user inline keyboard events
+    if update.callback_query:
+        query = update.callback_query
+        telegram_client = get_telegram_client()
+        # Stop the spinner on the button, whatever happens to the press
+        telegram_client.submit('answer_callback_query', callback_query_id=query.id)
+        # No age check: the age would be that of the message with the buttons, and buttons such as the page and
+        # org switcher ones are pressed long after it was sent. Re-deliveries are caught by the update_id dedupe.
+        telegram_client.submit('send_chat_action', chat_id=query.message.chat_id, action=ChatAction.TYPING)
+        inline_keyboard_handler(update)
+        return "ok"
+
+    return "error"
+
+
+cold_start['import_seconds'] = time.perf_counter() - IMPORT_STARTED
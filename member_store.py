@@ -0,0 +1,236 @@
+"""Compact in-memory storage of the active members of an instance.
+
+A dictionary of dictionaries costs several hundred bytes per member and scatters the coordinates over the heap.
+MemberStore keeps every value in a column instead: array('d') for the coordinates, the travel radius and the last
+write time, array('i') for the selected org, an id into an intern table of the org names. A member is a row;
+the usernames map to their row and the rows of removed members are reused.
+Unset values are NaN, or -1 for the org.
+
+Besides the current values, every row keeps the values last written to the datastore, so the bot can skip
+redundant writes without a second dictionary per member.
+"""
+
+import threading
+from array import array
+from datetime import datetime, timedelta
+
+NAN = float('nan')
+
+# The created_dttm column holds seconds since this naive UTC datetime.
+EPOCH = datetime(1970, 1, 1)
+
+# The columns of a row, current and persisted values alike.
+FLOAT_COLUMNS = ('travel_radius', 'latitude', 'longitude', 'created',
+                 'persisted_travel_radius', 'persisted_latitude', 'persisted_longitude', 'persisted_created')
+INT_COLUMNS = ('org', 'persisted_org')
+
+
+def _is_set(value):
+    return value == value  # NaN is the only value not equal to itself
+
+
+class MemberStore(object):
+    """The active members in columns. Thread-safe: a row is allocated, updated, read and freed under a lock,
+    so a row is never handed to another member while it is being written.
+    """
+
+    def __init__(self):
+        self._rows = {}
+        self._usernames = []
+        self._free_rows = []
+        self._org_codes = []
+        self._org_ids = {}
+        self._columns = {name: array('d') for name in FLOAT_COLUMNS}
+        self._columns.update((name, array('i')) for name in INT_COLUMNS)
+        # Reentrant, set() allocates the row and interns the org while holding it
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __contains__(self, username):
+        return username in self._rows
+
+    def __iter__(self):
+        # A copy, so members can be removed while iterating
+        return iter(list(self._rows))
+
+    def set(self, username, selected_org=None, travel_radius=None, latitude=None, longitude=None,
+            created_dttm=None):
+        """Add a member or update some of their values. The values left as None do not change.
+        Args:
+            username: member name.
+            selected_org: Optional. The org name.
+            travel_radius: Optional. The travel radius in km, a number or a numeric string.
+            latitude, longitude: Optional. The location.
+            created_dttm: Optional. The naive UTC datetime of the last write to the datastore.
+        """
+        columns = self._columns
+        with self._lock:
+            row = self._row(username)
+            if selected_org is not None:
+                columns['org'][row] = self._org_id(selected_org)
+            if travel_radius is not None:
+                columns['travel_radius'][row] = float(travel_radius)
+            if latitude is not None:
+                columns['latitude'][row] = latitude
+            if longitude is not None:
+                columns['longitude'][row] = longitude
+            if created_dttm is not None:
+                columns['created'][row] = (created_dttm - EPOCH).total_seconds()
+
+    def copy_member(self, source, username):
+        """Copy a member, with the values last written to the datastore, from another store.
+        Args:
+            source: the MemberStore holding the member.
+            username: member name.
+        """
+        with source._lock:
+            row = source._rows[username]
+            floats = [source._columns[name][row] for name in FLOAT_COLUMNS]
+            org_codes = [source._org_codes[org_id] if org_id >= 0 else None
+                         for org_id in (source._columns[name][row] for name in INT_COLUMNS)]
+        with self._lock:
+            row = self._row(username)
+            for name, value in zip(FLOAT_COLUMNS, floats):
+                self._columns[name][row] = value
+            for name, org_code in zip(INT_COLUMNS, org_codes):
+                self._columns[name][row] = self._org_id(org_code) if org_code is not None else -1
+
+    def remove(self, username):
+        """Remove a member, if present."""
+        with self._lock:
+            row = self._rows.pop(username, None)
+            if row is None:
+                return
+            self._usernames[row] = None
+            self._clear_row(row)
+            self._free_rows.append(row)
+
+    def selected_org(self, username):
+        """Get the selected org of a member, or None."""
+        with self._lock:
+            org_id = self._columns['org'][self._rows[username]]
+            return self._org_codes[org_id] if org_id >= 0 else None
+
+    def travel_radius(self, username):
+        """Get the travel radius of a member in km, or None."""
+        return self._float('travel_radius', username)
+
+    def location(self, username):
+        """Get the location of a member as a (latitude, longitude) pair, or None."""
+        with self._lock:
+            row = self._rows[username]
+            latitude = self._columns['latitude'][row]
+            if not _is_set(latitude):
+                return None
+            return latitude, self._columns['longitude'][row]
+
+    def created_dttm(self, username):
+        """Get the naive UTC datetime of the last write of a member to the datastore, or None."""
+        seconds = self._float('created', username)
+        return EPOCH + timedelta(seconds=seconds) if seconds is not None else None
+
+    def is_complete(self, username):
+        """Check whether a member has an org, a travel radius and a location, everything a Member entity needs."""
+        columns = self._columns
+        with self._lock:
+            row = self._rows[username]
+            return columns['org'][row] >= 0 and _is_set(columns['travel_radius'][row]) and \
+                _is_set(columns['latitude'][row])
+
+    def mark_persisted(self, username):
+        """Remember the current values of a member as the values in the datastore."""
+        columns = self._columns
+        with self._lock:
+            row = self._rows[username]
+            for name in ('org', 'travel_radius', 'latitude', 'longitude', 'created'):
+                columns['persisted_' + name][row] = columns[name][row]
+
+    def is_persisted(self, username):
+        """Check whether the current values of a member are the values last written to or read from the datastore.
+        """
+        columns = self._columns
+        with self._lock:
+            row = self._rows[username]
+            for name in ('org', 'travel_radius', 'latitude', 'longitude'):
+                current, persisted = columns[name][row], columns['persisted_' + name][row]
+                if current != persisted and (_is_set(current) or _is_set(persisted)):
+                    return False
+            return True
+
+    def persisted(self, username):
+        """Get the values of a member last written to the datastore.
+        Returns:
+            A (selected_org, travel_radius, latitude, longitude, created_dttm) tuple, or None if the member was not
+            written by or read from the datastore.
+        """
+        columns = self._columns
+        with self._lock:
+            row = self._rows[username]
+            org_id = columns['persisted_org'][row]
+            if org_id < 0:
+                return None
+            return (self._org_codes[org_id], columns['persisted_travel_radius'][row],
+                    columns['persisted_latitude'][row], columns['persisted_longitude'][row],
+                    EPOCH + timedelta(seconds=columns['persisted_created'][row]))
+
+    def coordinates(self, usernames):
+        """Gather the locations of several members straight from the columns.
+        Args:
+            usernames: members with a location.
+        Returns:
+            A numpy array of (latitude, longitude) rows.
+        """
+        import numpy as np
+        # The rows cannot be reused, and the arrays cannot grow while numpy views their buffers
+        with self._lock:
+            rows = np.fromiter((self._rows[username] for username in usernames), dtype=np.intp)
+            coordinates = np.empty((len(rows), 2))
+            if not len(rows):
+                return coordinates
+            coordinates[:, 0] = np.frombuffer(self._columns['latitude'], dtype=np.float64)[rows]
+            coordinates[:, 1] = np.frombuffer(self._columns['longitude'], dtype=np.float64)[rows]
+        return coordinates
+
+    def _row(self, username):
+        row = self._rows.get(username)
+        if row is not None:
+            return row
+        with self._lock:
+            row = self._rows.get(username)
+            if row is not None:
+                return row
+            if self._free_rows:
+                row = self._free_rows.pop()
+                self._usernames[row] = username
+            else:
+                row = len(self._usernames)
+                self._usernames.append(username)
+                for name in FLOAT_COLUMNS:
+                    self._columns[name].append(NAN)
+                for name in INT_COLUMNS:
+                    self._columns[name].append(-1)
+            self._rows[username] = row
+            return row
+
+    def _clear_row(self, row):
+        for name in FLOAT_COLUMNS:
+            self._columns[name][row] = NAN
+        for name in INT_COLUMNS:
+            self._columns[name][row] = -1
+
+    def _org_id(self, org_code):
+        org_id = self._org_ids.get(org_code)
+        if org_id is None:
+            with self._lock:
+                org_id = self._org_ids.get(org_code)
+                if org_id is None:
+                    org_id = self._org_ids[org_code] = len(self._org_codes)
+                    self._org_codes.append(org_code)
+        return org_id
+
+    def _float(self, name, username):
+        with self._lock:
+            value = self._columns[name][self._rows[username]]
+        return value if _is_set(value) else None
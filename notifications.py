@@ -0,0 +1,106 @@
+"""Rate-limited delivery of the "someone is nearby" notifications.
+
+The webhook never sends the notifications itself: it writes them to an outbox and returns. A DeliveryQueue then
+sends them within the Telegram limits: about 30 messages per second overall and one message per second per chat.
+A 429 answer (RetryAfter) pauses all sending for the retry_after seconds Telegram asks for and the message goes
+back to the queue. Timeouts are retried too, any other error fails the message.
+"""
+
+import logging
+import time
+from collections import deque
+
+from telegram.error import RetryAfter, TimedOut
+
+from ratelimit import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+
+class DeliveryQueue(object):
+    """Sends notifications with a global and a per-chat token bucket.
+    The notifications are dictionaries with at least a 'chat_id'. Chats take turns, so one chat with many
+    notifications does not hold back the others.
+    """
+
+    def __init__(self, send, global_rate=30.0, chat_rate=1.0, max_retries=3):
+        """
+        Args:
+            send: a function sending one notification; it raises the telegram.error exceptions.
+            global_rate: the messages per second for all the chats together.
+            chat_rate: the messages per second for one chat.
+            max_retries: how many times a message is retried after RetryAfter or a timeout.
+        """
+        self.send = send
+        self.chat_rate = chat_rate
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket(global_rate)
+        self._chat_buckets = {}
+
+    def deliver(self, notifications, deadline=None):
+        """Send notifications until all of them are done or the deadline passes.
+        Args:
+            notifications: the notifications to send.
+            deadline: Optional. A time.monotonic() value; the notifications not sent by then are left over.
+        Returns:
+            A (delivered, failed, left_over) tuple. failed is a list of (notification, error) pairs.
+        """
+        queue = deque((notification, 0) for notification in notifications)
+        delivered, failed = [], []
+        # The number of notifications in a row skipped because their chat had to wait
+        skipped, min_chat_wait = 0, None
+        while queue:
+            notification, attempts = queue.popleft()
+            chat_wait = self._chat_bucket(notification['chat_id']).wait_time()
+            if chat_wait > 0:
+                queue.append((notification, attempts))
+                skipped += 1
+                min_chat_wait = chat_wait if min_chat_wait is None else min(min_chat_wait, chat_wait)
+                if skipped < len(queue):
+                    continue
+                # Every chat in the queue has to wait, sleep until the first one may send
+                if self._past(deadline, min_chat_wait):
+                    break
+                time.sleep(min_chat_wait)
+                skipped, min_chat_wait = 0, None
+                continue
+            skipped, min_chat_wait = 0, None
+
+            if self._past(deadline, self.global_bucket.wait_time()):
+                queue.appendleft((notification, attempts))
+                break
+            self.global_bucket.acquire()
+            self._chat_bucket(notification['chat_id']).try_acquire()
+            try:
+                self.send(notification)
+            except RetryAfter as error:
+                logger.warning('Telegram asked to retry after %s s', error.retry_after)
+                # Flood control applies to the whole bot, not only to this chat
+                self.global_bucket.pause(error.retry_after)
+                self._requeue(queue, notification, attempts, error, failed)
+            except TimedOut as error:
+                self._requeue(queue, notification, attempts, error, failed)
+            except Exception as error:
+                logger.warning('Notification to chat %s failed: %s', notification['chat_id'], error)
+                failed.append((notification, error))
+            else:
+                delivered.append(notification)
+        return delivered, failed, [notification for notification, _ in queue]
+
+    def _requeue(self, queue, notification, attempts, error, failed):
+        if attempts < self.max_retries:
+            queue.append((notification, attempts + 1))
+        else:
+            logger.warning('Notification to chat %s failed after %d retries: %s',
+                           notification['chat_id'], attempts, error)
+            failed.append((notification, error))
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate, capacity=1)
+        return bucket
+
+    @staticmethod
+    def _past(deadline, delay):
+        return deadline is not None and time.monotonic() + delay >= deadline
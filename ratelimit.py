@@ -0,0 +1,86 @@
+"""Token bucket rate limiting.
+
+A bucket holds up to `capacity` tokens and refills at `rate` tokens per second. Every operation takes a token,
+so the long run rate is bounded by `rate` while bursts of up to `capacity` operations go through at once.
+"""
+
+import threading
+import time
+
+
+class TokenBucket(object):
+    """A thread-safe token bucket. The clock is time.monotonic() unless another one is given, e.g. in benchmarks."""
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(rate, 1))
+        self.clock = clock
+        self._tokens = self.capacity
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def try_acquire(self, tokens=1, reserve=0):
+        """Take tokens if the bucket has enough.
+        Args:
+            tokens: Optional. The number of tokens to take, 1 by default.
+            reserve: Optional. The number of tokens that must be left in the bucket afterwards, so callers
+                passing a reserve leave the last tokens to the callers that do not.
+        Returns:
+            True if the tokens were taken.
+        """
+        with self._lock:
+            self._refill()
+            if self._tokens - tokens >= reserve:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def refund(self, tokens=1):
+        """Give back tokens taken by try_acquire() for an operation that did not happen.
+        Args:
+            tokens: Optional. The number of tokens to give back, 1 by default.
+        """
+        with self._lock:
+            self._refill()
+            self._tokens = min(self.capacity, self._tokens + tokens)
+
+    def wait_time(self, tokens=1):
+        """Get how long it takes until the bucket has enough tokens.
+        Args:
+            tokens: Optional. The number of tokens needed, 1 by default.
+        Returns:
+            The number of seconds, 0 if the tokens are available now.
+        """
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                return 0.0
+            return (tokens - self._tokens) / self.rate
+
+    def acquire(self, tokens=1):
+        """Take tokens, sleeping until the bucket has enough.
+        Args:
+            tokens: Optional. The number of tokens to take, 1 by default.
+        Returns:
+            The number of seconds slept.
+        """
+        slept = 0.0
+        while not self.try_acquire(tokens):
+            delay = self.wait_time(tokens)
+            time.sleep(delay)
+            slept += delay
+        return slept
+
+    def pause(self, seconds):
+        """Empty the bucket for a number of seconds, e.g. when the server asks to retry later.
+        Args:
+            seconds: how long no tokens are available.
+        """
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, 0.0) - seconds * self.rate
+
+    def _refill(self):
+        now = self.clock()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+
+"""Run the bot as a long running process instead of a Cloud Function.
+
+The updates come either from getUpdates long polling or from a small webhook HTTP server, both on an asyncio event
+loop. Each update goes through the same code as the Cloud Function, main.process_update(), on a thread pool:
+the handlers and the storage and Telegram clients are blocking, so they run on the pool while the event loop
+only receives updates. Updates of different users run concurrently; the updates of one user run one after the
+other, in the order they arrived.
+
+Differences from the Cloud Function:
+    - Replies are sent as Bot API calls, the webhook server acknowledges an update as soon as it is queued.
+      A failed update is logged, Telegram does not retry it.
+    - With --flush-interval, member changes are written on a timer instead of at the end of every update.
+Usage:
+    python server.py polling [--concurrency 16]
+    python server.py webhook [--host 0.0.0.0] [--port 8080] [--path /] [--secret-token TOKEN]
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import signal
+import sys
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+logger = logging.getLogger(__name__)
+
+# The update fields whose sender orders the updates.
+ORDERED_FIELDS = ('message', 'edited_message', 'callback_query')
+
+
+def ordering_key(payload):
+    """Get the key that orders an update: the Telegram user who sent it.
+    Args:
+        payload: the update as a dictionary.
+    Returns:
+        The user id, or a key unique to the update if it has no sender.
+    """
+    for field in ORDERED_FIELDS:
+        content = payload.get(field)
+        if content:
+            sender = content.get('from') or content.get('chat') or {}
+            if 'id' in sender:
+                return sender['id']
+    return 'update', payload.get('update_id')
+
+
+class OrderedDispatcher(object):
+    """Runs a blocking update handler on a thread pool, concurrently across users and in order per user.
+    Every update waits for the previous update of the same user, whether it succeeded or not.
+    At most max_pending updates are queued or running; dispatch() waits for a free slot, which slows down
+    the poller or the webhook clients when the handlers fall behind.
+    """
+
+    def __init__(self, handle, concurrency=16, max_pending=1000):
+        self.handle = handle
+        self.stats = Counter()
+        self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='handler')
+        self._slots = asyncio.Semaphore(max_pending)
+        self._tails = {}
+        self._tasks = set()
+
+    async def dispatch(self, payload):
+        """Queue an update.
+        Args:
+            payload: the update as a dictionary.
+        Returns:
+            The asyncio Task handling the update.
+        """
+        await self._slots.acquire()
+        key = ordering_key(payload)
+        task = asyncio.ensure_future(self._run(self._tails.get(key), payload))
+        self._tails[key] = task
+        self._tasks.add(task)
+        task.add_done_callback(partial(self._done, key))
+        self.stats['dispatched'] += 1
+        return task
+
+    @property
+    def pending(self):
+        """The number of updates queued or running."""
+        return len(self._tasks)
+
+    async def drain(self):
+        """Wait for all the queued updates."""
+        while self._tasks:
+            await asyncio.wait(list(self._tasks))
+
+    def shutdown(self):
+        """Stop the thread pool, after the running handlers finish."""
+        self._executor.shutdown(wait=True)
+
+    async def _run(self, previous, payload):
+        if previous is not None:
+            # Wait without raising, an update runs after the previous one of the user even if that one failed
+            await asyncio.wait([previous])
+        try:
+            await asyncio.get_running_loop().run_in_executor(self._executor, self.handle, payload)
+            self.stats['handled'] += 1
+        except Exception:
+            self.stats['failed'] += 1
+            logger.exception('Update %s failed', payload.get('update_id'))
+
+    def _done(self, key, task):
+        self._tasks.discard(task)
+        if self._tails.get(key) is task:
+            del self._tails[key]
+        self._slots.release()
+
+
+async def poll_updates(dispatcher, bot, poll_timeout):
+    """Receive updates with getUpdates long polling and dispatch them, until cancelled.
+    Args:
+        dispatcher: the OrderedDispatcher.
+        bot: the telegram.Bot.
+        poll_timeout: the long polling timeout in seconds.
+    """
+    from telegram.error import RetryAfter, TelegramError
+
+    loop = asyncio.get_running_loop()
+    # getUpdates does not work while a webhook is set
+    await loop.run_in_executor(None, bot.delete_webhook)
+    offset = None
+    backoff = 1
+    while True:
+        try:
+            updates = await loop.run_in_executor(None, partial(
+                bot.get_updates, offset=offset, timeout=poll_timeout, allowed_updates=list(ORDERED_FIELDS)))
+            backoff = 1
+        except RetryAfter as error:
+            await asyncio.sleep(error.retry_after)
+            continue
+        except TelegramError as error:
+            logger.warning('getUpdates failed, retrying in %d s: %s', backoff, error)
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 60)
+            continue
+        for update in updates:
+            offset = update.update_id + 1
+            await dispatcher.dispatch(update.to_dict())
+
+
+async def serve_webhook(dispatcher, host, port, path, secret_token=None):
+    """Start a minimal HTTP/1.1 server receiving the webhook updates.
+    Args:
+        dispatcher: the OrderedDispatcher.
+        host, port: the address to listen on.
+        path: the URL path of the webhook.
+        secret_token: Optional. The secret_token given to setWebhook; requests without it are rejected.
+    Returns:
+        The asyncio Server.
+    """
+    async def handle_request(method, target, headers, body):
+        if target.split('?', 1)[0] != path:
+            return 404, 'not found'
+        if method != 'POST':
+            return 405, 'only POST accepted'
+        if secret_token and headers.get('x-telegram-bot-api-secret-token') != secret_token:
+            return 403, 'forbidden'
+        try:
+            payload = json.loads(body.decode('utf-8'))
+        except ValueError:
+            return 400, 'invalid JSON'
+        await dispatcher.dispatch(payload)
+        return 200, 'ok'
+
+    async def handle_connection(reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', '0')))
+                status, text = await handle_request(method, target, headers, body)
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                text = text.encode('utf-8')
+                writer.write('HTTP/1.1 {} {}\r\nContent-Type: text/plain\r\nContent-Length: {}\r\n{}\r\n'.format(
+                    status, 'OK' if status == 200 else 'Error', len(text),
+                    '' if keep_alive else 'Connection: close\r\n').encode('latin-1') + text)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, ValueError) as error:
+            logger.debug('Webhook connection closed: %s', error)
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle_connection, host, port)
+    logger.info('Webhook server listening on %s:%d%s', host, port, path)
+    return server
+
+
+async def serve(args, bot):
+    """Run the server until SIGINT or SIGTERM, then finish the queued updates and the member writes."""
+    if args.flush_interval > 0:
+        bot.start_member_write_flusher(args.flush_interval)
+    dispatcher = OrderedDispatcher(partial(bot.process_update, flush_writes=args.flush_interval <= 0),
+                                   args.concurrency, args.max_pending)
+
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signal_number, stopped.set)
+
+    if args.mode == 'polling':
+        poller = asyncio.ensure_future(poll_updates(dispatcher, bot.get_telegram_client().bot, args.poll_timeout))
+        await asyncio.wait([poller, asyncio.ensure_future(stopped.wait())], return_when=asyncio.FIRST_COMPLETED)
+        poller.cancel()
+    else:
+        server = await serve_webhook(dispatcher, args.host, args.port, args.path, args.secret_token)
+        await stopped.wait()
+        server.close()
+        await server.wait_closed()
+
+    logger.info('Stopping, %d updates queued', dispatcher.pending)
+    await dispatcher.drain()
+    dispatcher.shutdown()
+    bot.flush_member_writes()
+    logger.info('Stopped: %s', dict(dispatcher.stats))
+    logger.info('Telegram call latency: %s', bot.get_telegram_client().latency_stats())
+    if bot.ADMISSION_CONTROL:
+        logger.info('Admission control: %s', dict(bot.get_admission_controller().stats))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('mode', choices=('polling', 'webhook'), help='how to receive the updates')
+    parser.add_argument('--concurrency', type=int, default=16, help='updates handled at the same time')
+    parser.add_argument('--max-pending', type=int, default=1000, help='updates queued before receiving pauses')
+    parser.add_argument('--flush-interval', type=float, default=1.0,
+                        help='seconds between member write flushes, 0 to flush after every update')
+    parser.add_argument('--poll-timeout', type=int, default=30, help='getUpdates long polling timeout')
+    parser.add_argument('--host', default='0.0.0.0', help='webhook server address')
+    parser.add_argument('--port', type=int, default=8080, help='webhook server port')
+    parser.add_argument('--path', default='/', help='webhook URL path')
+    parser.add_argument('--secret-token', help='the secret_token given to setWebhook')
+    args = parser.parse_args(argv)
+
+    # The handler threads call the Bot API themselves while as many workers run the submitted calls, the connection
+    # pool covers both
+    os.environ.setdefault('TELEGRAM_WORKERS', str(args.concurrency))
+    os.environ.setdefault('TELEGRAM_HANDLER_THREADS', str(args.concurrency))
+    import main as bot
+    # Replies cannot ride on the webhook response, it is sent before the update is handled
+    bot.get_telegram_client().inline_replies = False
+    asyncio.run(serve(args, bot))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,124 @@
+"""A compact binary snapshot of the organizations and the active members, for the warm-up of new instances.
+
+A cold instance would otherwise rebuild its state by scanning the Membership and Member kinds. The snapshot
+holds the same data in one zlib compressed blob: a string table with the org names and the usernames, the
+memberships as pairs of string indices, and the members as columns of string indices and doubles.
+Layout, little-endian, after the 4 byte header (MAGIC and FORMAT_VERSION) the rest is compressed:
+    created (double, seconds since EPOCH), memberships (uint32), members (uint32), string table size (uint32)
+    the string table, NUL separated UTF-8
+    membership org and username indices (uint32 arrays)
+    member username and org indices (uint32 arrays), travel radius, latitude, longitude, created (double arrays)
+"""
+
+import struct
+import sys
+import zlib
+from array import array
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+MAGIC = b'WMS'
+FORMAT_VERSION = 1
+
+# Datetimes are stored as seconds since this naive UTC datetime.
+EPOCH = datetime(1970, 1, 1)
+
+HEADER = struct.Struct('<3sB')
+COUNTS = struct.Struct('<dIII')
+
+# A decoded snapshot. memberships are (org_code, username) pairs; members are
+# (username, selected_org, travel_radius, latitude, longitude, created_dttm) tuples.
+Snapshot = namedtuple('Snapshot', ['created_dttm', 'memberships', 'members'])
+
+
+class SnapshotError(ValueError):
+    """The blob is not a snapshot this version can read."""
+
+
+def encode_snapshot(snapshot):
+    """Encode a snapshot.
+    Args:
+        snapshot: a Snapshot.
+    Returns:
+        The blob, as bytes.
+    """
+    strings = {}
+
+    def string_index(value):
+        index = strings.get(value)
+        if index is None:
+            index = strings[value] = len(strings)
+        return index
+
+    membership_orgs = array('I', (string_index(org_code) for org_code, _ in snapshot.memberships))
+    membership_users = array('I', (string_index(username) for _, username in snapshot.memberships))
+    member_users = array('I', (string_index(member[0]) for member in snapshot.members))
+    member_orgs = array('I', (string_index(member[1]) for member in snapshot.members))
+    columns = [array('d', (float(member[position]) for member in snapshot.members)) for position in (2, 3, 4)]
+    columns.append(array('d', ((member[5] - EPOCH).total_seconds() for member in snapshot.members)))
+
+    string_table = '\0'.join(strings).encode('utf-8')
+    parts = [COUNTS.pack((snapshot.created_dttm - EPOCH).total_seconds(), len(snapshot.memberships),
+                         len(snapshot.members), len(string_table)), string_table]
+    for column in [membership_orgs, membership_users, member_users, member_orgs] + columns:
+        if sys.byteorder == 'big':
+            column.byteswap()
+        parts.append(column.tobytes())
+    return HEADER.pack(MAGIC, FORMAT_VERSION) + zlib.compress(b''.join(parts))
+
+
+def decode_snapshot(blob):
+    """Decode a snapshot.
+    Args:
+        blob: bytes made by encode_snapshot().
+    Returns:
+        The Snapshot.
+    Raises:
+        SnapshotError: the blob has another format or is damaged.
+    """
+    try:
+        magic, format_version = HEADER.unpack_from(blob)
+        if magic != MAGIC or format_version != FORMAT_VERSION:
+            raise SnapshotError('Unsupported snapshot format {!r} {}'.format(magic, format_version))
+        data = memoryview(zlib.decompress(blob[HEADER.size:]))
+        created, membership_count, member_count, string_table_size = COUNTS.unpack_from(data)
+        offset = COUNTS.size
+        string_table = bytes(data[offset:offset + string_table_size]).decode('utf-8')
+        strings = string_table.split('\0') if string_table else []
+        offset += string_table_size
+
+        def read_column(typecode, count):
+            nonlocal offset
+            column = array(typecode)
+            size = column.itemsize * count
+            column.frombytes(data[offset:offset + size])
+            if len(column) != count:
+                raise SnapshotError('Truncated snapshot')
+            if sys.byteorder == 'big':
+                column.byteswap()
+            offset += size
+            return column
+
+        membership_orgs = read_column('I', membership_count)
+        membership_users = read_column('I', membership_count)
+        member_users = read_column('I', member_count)
+        member_orgs = read_column('I', member_count)
+        radii, latitudes, longitudes, created_column = (read_column('d', member_count) for _ in range(4))
+        memberships = [(strings[org], strings[user]) for org, user in zip(membership_orgs, membership_users)]
+        members = [(strings[user], strings[org], radius, latitude, longitude, EPOCH + timedelta(seconds=seconds))
+                   for user, org, radius, latitude, longitude, seconds
+                   in zip(member_users, member_orgs, radii, latitudes, longitudes, created_column)]
+    except (struct.error, zlib.error, UnicodeDecodeError, IndexError) as error:
+        raise SnapshotError('Damaged snapshot: {}'.format(error))
+    return Snapshot(EPOCH + timedelta(seconds=created), memberships, members)
+
+
+def split_blob(blob, chunk_size):
+    """Split a blob into chunks that fit in one entity property.
+    Args:
+        blob: the bytes.
+        chunk_size: the maximum chunk size in bytes.
+    Returns:
+        A list of at least one chunk.
+    """
+    return [blob[start:start + chunk_size] for start in range(0, len(blob), chunk_size)] or [b'']
@@ -0,0 +1,314 @@
+"""Storage backends for the bot.
+
+All persistence goes through a Storage object with the same small interface: keys, batch get/put/delete,
+filtered queries, counts and an idempotent transactional insert. The entities are
+google.cloud.datastore Entity objects for every backend, so the callers do not depend on the backend.
+
+Backends:
+    datastore: Google Cloud Datastore (the default).
+    memory: in-process dictionaries, for benchmarks and load tests without GCP.
+    sqlite: a local SQLite file, for offline runs that need to keep the data between processes.
+The backend is selected with the STORAGE_BACKEND environment variable.
+"""
+
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+from collections import Counter
+from datetime import datetime, timezone
+
+from google.cloud import datastore
+from google.cloud.datastore.helpers import GeoPoint  # noqa: F401 re-exported for the callers
+
+logger = logging.getLogger(__name__)
+
+# Comparison operators supported by query filters.
+FILTER_OPERATORS = {
+    '=': lambda value, other: value == other,
+    '<': lambda value, other: value < other,
+    '<=': lambda value, other: value <= other,
+    '>': lambda value, other: value > other,
+    '>=': lambda value, other: value >= other,
+}
+
+
+class Storage(object):
+    """The storage interface. Filters are (property, operator, value) tuples, e.g. ('created_dttm', '>', dttm).
+    Every backend counts the entities it reads, writes and deletes in the stats Counter.
+    """
+
+    def __init__(self):
+        self.stats = Counter()
+        self._stats_lock = threading.Lock()
+
+    def key(self, *path):
+        """Build a key from a path of kinds and names, e.g. key('Organization', 'PY', 'Membership', 'user')."""
+        raise NotImplementedError
+
+    def entity(self, key, exclude_from_indexes=()):
+        """Build a new entity for a key."""
+        return datastore.Entity(key, exclude_from_indexes=exclude_from_indexes)
+
+    def get(self, key):
+        """Get one entity, or None if it does not exist."""
+        found = self.get_multi([key])
+        return found[0] if found else None
+
+    def get_multi(self, keys):
+        """Get the existing entities for a list of keys."""
+        raise NotImplementedError
+
+    def put(self, entity):
+        """Insert or update one entity."""
+        self.put_multi([entity])
+
+    def put_multi(self, entities):
+        """Insert or update a batch of entities."""
+        raise NotImplementedError
+
+    def delete_multi(self, keys):
+        """Delete a batch of entities by key."""
+        raise NotImplementedError
+
+    def query(self, kind, filters=(), ancestor=None, keys_only=False):
+        """Iterate over the entities of a kind that match all the filters.
+        With keys_only, the entities only have their key set.
+        """
+        raise NotImplementedError
+
+    def count(self, kind, filters=()):
+        """Count the entities of a kind that match all the filters."""
+        raise NotImplementedError
+
+    def add_if_absent(self, entity):
+        """Insert an entity in a transaction, unless an entity with the same key exists.
+        Returns True if the entity was inserted.
+        """
+        raise NotImplementedError
+
+    def reset_stats(self):
+        """Reset the read/write/delete counters and return their previous values."""
+        with self._stats_lock:
+            stats = self.stats
+            self.stats = Counter()
+        return stats
+
+    def _count(self, operation, number=1):
+        with self._stats_lock:
+            self.stats[operation] += number
+
+
+class DatastoreStorage(Storage):
+    """Google Cloud Datastore backend."""
+
+    def __init__(self, client=None):
+        super(DatastoreStorage, self).__init__()
+        self.client = client or datastore.Client()
+
+    def key(self, *path):
+        return self.client.key(*path)
+
+    def get_multi(self, keys):
+        entities = self.client.get_multi(keys)
+        self._count('reads', len(entities))
+        return entities
+
+    def put_multi(self, entities):
+        self.client.put_multi(entities)
+        self._count('writes', len(entities))
+
+    def delete_multi(self, keys):
+        self.client.delete_multi(keys)
+        self._count('deletes', len(keys))
+
+    def query(self, kind, filters=(), ancestor=None, keys_only=False):
+        query = self._build_query(kind, filters, ancestor)
+        if keys_only:
+            query.keys_only()
+        self._count('queries')
+        for entity in query.fetch():
+            self._count('reads')
+            yield entity
+
+    def count(self, kind, filters=()):
+        self._count('queries')
+        aggregation = self.client.aggregation_query(self._build_query(kind, filters)).count()
+        return sum(result.value for batch in aggregation.fetch() for result in batch)
+
+    def add_if_absent(self, entity):
+        with self.client.transaction():
+            self._count('reads')
+            if self.client.get(entity.key) is not None:
+                return False
+            self.client.put(entity)
+        self._count('writes')
+        return True
+
+    def _build_query(self, kind, filters, ancestor=None):
+        query = self.client.query(kind=kind, ancestor=ancestor)
+        for property_name, operator, value in filters:
+            query.add_filter(filter=datastore.query.PropertyFilter(property_name, operator, value))
+        return query
+
+
+class LocalStorage(Storage):
+    """Base class of the local backends. It keeps Datastore semantics where the bot relies on them:
+    datetimes come back timezone aware in UTC and stored entities are copies, not shared objects.
+    Subclasses implement the raw row access.
+    """
+
+    def __init__(self, project='local'):
+        super(LocalStorage, self).__init__()
+        self.project = project
+        self._lock = threading.RLock()
+
+    def key(self, *path):
+        return datastore.Key(*path, project=self.project)
+
+    def get_multi(self, keys):
+        with self._lock:
+            entities = [self._to_entity(key, self._read(key.flat_path)) for key in keys]
+        entities = [entity for entity in entities if entity is not None]
+        self._count('reads', len(entities))
+        return entities
+
+    def put_multi(self, entities):
+        with self._lock:
+            for entity in entities:
+                self._write(entity.key.flat_path, _stored_properties(entity))
+        self._count('writes', len(entities))
+
+    def delete_multi(self, keys):
+        with self._lock:
+            for key in keys:
+                self._delete(key.flat_path)
+        self._count('deletes', len(keys))
+
+    def query(self, kind, filters=(), ancestor=None, keys_only=False):
+        self._count('queries')
+        for path, properties in self._matching(kind, filters, ancestor):
+            self._count('reads')
+            key = self.key(*path)
+            yield datastore.Entity(key) if keys_only else self._to_entity(key, properties)
+
+    def count(self, kind, filters=()):
+        self._count('queries')
+        return sum(1 for _ in self._matching(kind, filters))
+
+    def add_if_absent(self, entity):
+        with self._lock:
+            self._count('reads')
+            if self._read(entity.key.flat_path) is not None:
+                return False
+            self.put(entity)
+        return True
+
+    def _matching(self, kind, filters, ancestor=None):
+        filters = [(name, FILTER_OPERATORS[operator], _stored_value(value)) for name, operator, value in filters]
+        prefix = ancestor.flat_path if ancestor is not None else ()
+        with self._lock:
+            rows = self._scan(kind)
+        return [(path, properties) for path, properties in rows if path[:len(prefix)] == prefix and
+                all(name in properties and matches(properties[name], value) for name, matches, value in filters)]
+
+    def _to_entity(self, key, properties):
+        if properties is None:
+            return None
+        entity = datastore.Entity(key)
+        entity.update(properties)
+        return entity
+
+    def _read(self, path):
+        raise NotImplementedError
+
+    def _write(self, path, properties):
+        raise NotImplementedError
+
+    def _delete(self, path):
+        raise NotImplementedError
+
+    def _scan(self, kind):
+        raise NotImplementedError
+
+
+class MemoryStorage(LocalStorage):
+    """In-process backend. The data lives as long as the process."""
+
+    def __init__(self, project='local'):
+        super(MemoryStorage, self).__init__(project)
+        self._rows = {}
+
+    def _read(self, path):
+        properties = self._rows.get(path)
+        return dict(properties) if properties is not None else None
+
+    def _write(self, path, properties):
+        self._rows[path] = properties
+
+    def _delete(self, path):
+        self._rows.pop(path, None)
+
+    def _scan(self, kind):
+        return [(path, dict(properties)) for path, properties in self._rows.items() if path[-2] == kind]
+
+
+class SqliteStorage(LocalStorage):
+    """SQLite backend. The properties of an entity are pickled into one row keyed by the key path."""
+
+    def __init__(self, path, project='local'):
+        super(SqliteStorage, self).__init__(project)
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute('CREATE TABLE IF NOT EXISTS entities '
+                                 '(path TEXT PRIMARY KEY, kind TEXT NOT NULL, properties BLOB NOT NULL)')
+        self._connection.execute('CREATE INDEX IF NOT EXISTS entities_kind ON entities (kind)')
+        self._connection.commit()
+
+    def _read(self, path):
+        row = self._connection.execute('SELECT properties FROM entities WHERE path = ?',
+                                       (json.dumps(path),)).fetchone()
+        return pickle.loads(row[0]) if row else None
+
+    def _write(self, path, properties):
+        self._connection.execute('INSERT OR REPLACE INTO entities (path, kind, properties) VALUES (?, ?, ?)',
+                                 (json.dumps(path), path[-2], pickle.dumps(properties)))
+        self._connection.commit()
+
+    def _delete(self, path):
+        self._connection.execute('DELETE FROM entities WHERE path = ?', (json.dumps(path),))
+        self._connection.commit()
+
+    def _scan(self, kind):
+        rows = self._connection.execute('SELECT path, properties FROM entities WHERE kind = ?', (kind,))
+        return [(tuple(json.loads(path)), pickle.loads(properties)) for path, properties in rows]
+
+
+def storage_from_env():
+    """Build the storage backend selected by the STORAGE_BACKEND environment variable.
+    Returns:
+        A Storage object.
+    """
+    backend = os.environ.get('STORAGE_BACKEND', 'datastore')
+    logger.info('Using the "%s" storage backend', backend)
+    if backend == 'datastore':
+        return DatastoreStorage()
+    if backend == 'memory':
+        return MemoryStorage()
+    if backend == 'sqlite':
+        return SqliteStorage(os.environ.get('SQLITE_PATH', 'bot.sqlite3'))
+    raise ValueError('Unknown STORAGE_BACKEND "{}"'.format(backend))
+
+
+def _stored_value(value):
+    # Datastore stores datetimes in UTC and returns them timezone aware
+    if isinstance(value, datetime):
+        if value.tzinfo is None:
+            return value.replace(tzinfo=timezone.utc)
+        return value.astimezone(timezone.utc)
+    return value
+
+
+def _stored_properties(entity):
+    return {name: _stored_value(value) for name, value in entity.items()}
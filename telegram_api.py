@@ -0,0 +1,182 @@
+"""A thin layer over the Telegram Bot for the outbound API calls of the webhook.
+
+The Bot shares one pool of keep-alive HTTPS connections, so independent calls made while handling
+an update can run concurrently on a small thread pool instead of one after another.
+Every call is timed and the latency is kept per Bot API method.
+
+Telegram also accepts one Bot API call in the HTTP response to a webhook update. With inline replies enabled,
+the last reply of a handler is held back and returned as the webhook response, which saves one outbound request.
+"""
+
+import logging
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from telegram import Bot
+from telegram.utils.request import Request
+
+from instrumentation import current_trace
+
+logger = logging.getLogger(__name__)
+
+
+def build_bot(token, workers, handler_threads=1):
+    """Build a Bot with a connection pool large enough for concurrent calls.
+    Args:
+        token: the Telegram bot token.
+        workers: the number of submitted calls that may run concurrently.
+        handler_threads: Optional. The number of threads making synchronous calls, 1 by default.
+    Returns:
+        The Bot.
+    """
+    # One connection per worker, plus one per thread making the synchronous calls of a handler
+    return Bot(token=token, request=Request(con_pool_size=workers + handler_threads))
+
+
+class TelegramClient(object):
+    """Runs Bot API calls synchronously or on a thread pool and records their latency.
+    Calls submitted while handling an update are tracked, so the webhook can wait for them before it returns.
+    """
+
+    def __init__(self, bot, workers=4, inline_replies=False):
+        self.bot = bot
+        self.inline_replies = inline_replies
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='telegram')
+        self._local = threading.local()
+        self._latency_lock = threading.Lock()
+        self._latency = defaultdict(lambda: {'count': 0, 'errors': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+
+    def call(self, method, **kwargs):
+        """Call a Bot API method and wait for the result.
+        Args:
+            method: the name of the Bot method, e.g. 'send_message'.
+            kwargs: the arguments of the method.
+        Returns:
+            The result of the method.
+        """
+        return self._call(current_trace(), method, kwargs)
+
+    def reply(self, method, **kwargs):
+        """Send a reply of the current update. With inline replies enabled, the reply is held back until the
+        next reply or the end of the update, so only the last reply can become the webhook response.
+        Replies are always delivered in order.
+        Args:
+            method: the name of the Bot method, e.g. 'send_message'.
+            kwargs: the arguments of the method.
+        Returns:
+            None; output is written to Stackdriver Logging.
+        """
+        if not self.inline_replies:
+            self.call(method, **kwargs)
+            return
+        self.flush_reply()
+        self._local.held_reply = (method, kwargs)
+
+    def flush_reply(self):
+        """Send the held reply of the current thread, if any, and wait for it.
+        Returns:
+            None; output is written to Stackdriver Logging.
+        """
+        held_reply = getattr(self._local, 'held_reply', None)
+        self._local.held_reply = None
+        if held_reply:
+            method, kwargs = held_reply
+            self.call(method, **kwargs)
+
+    def take_reply(self):
+        """Take the held reply of the current thread as a webhook response payload, without sending it.
+        Returns:
+            A dictionary with the Bot API method and its parameters, or None if no reply is held.
+        """
+        held_reply = getattr(self._local, 'held_reply', None)
+        self._local.held_reply = None
+        if not held_reply:
+            return None
+        method, kwargs = held_reply
+        # Counted separately, the call costs no outbound request
+        self._record(method + ' (inline)', 0.0, False)
+        return webhook_payload(method, kwargs)
+
+    def submit(self, method, **kwargs):
+        """Start a Bot API call on the thread pool without waiting for it.
+        Args:
+            method: the name of the Bot method, e.g. 'answer_callback_query'.
+            kwargs: the arguments of the method.
+        Returns:
+            A Future with the result of the method.
+        """
+        # The call runs on another thread, so it records its span into the trace of the current update explicitly
+        future = self._executor.submit(self._call, current_trace(), method, kwargs)
+        future.method = method
+        self._pending().append(future)
+        return future
+
+    def wait_pending(self, timeout=None):
+        """Wait for the calls submitted by the current thread. Failed calls are logged, not raised.
+        Args:
+            timeout: Optional. The maximum number of seconds to wait.
+        Returns:
+            None; output is written to Stackdriver Logging.
+        """
+        pending = self._pending()
+        self._local.pending = []
+        done, not_done = wait(pending, timeout=timeout)
+        for future in done:
+            if future.exception() is not None:
+                logger.error('Telegram call "%s" failed: %s', future.method, future.exception())
+        for future in not_done:
+            logger.warning('Telegram call "%s" did not finish in time', future.method)
+
+    def latency_stats(self):
+        """Get the latency statistics of the calls made so far.
+        Returns:
+            A dictionary of Bot method names to their call count, error count, total and max latency in ms.
+        """
+        with self._latency_lock:
+            return {method: dict(stats) for method, stats in self._latency.items()}
+
+    def _call(self, trace, method, kwargs):
+        started = time.perf_counter()
+        failed = True
+        try:
+            result = getattr(self.bot, method)(**kwargs)
+            failed = False
+            return result
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self._record(method, elapsed_ms, failed)
+            if trace is not None:
+                trace.add_span('telegram.' + method, elapsed_ms, {'error': True} if failed else None)
+
+    def _pending(self):
+        if not hasattr(self._local, 'pending'):
+            self._local.pending = []
+        return self._local.pending
+
+    def _record(self, method, elapsed_ms, failed):
+        logger.debug('Telegram call "%s" took %.1f ms', method, elapsed_ms)
+        with self._latency_lock:
+            stats = self._latency[method]
+            stats['count'] += 1
+            stats['errors'] += int(failed)
+            stats['total_ms'] += elapsed_ms
+            stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+
+
+def webhook_payload(method, kwargs):
+    """Build the webhook response payload for a Bot API call.
+    Args:
+        method: the name of the Bot method, e.g. 'send_message'.
+        kwargs: the arguments of the method. Telegram objects such as keyboards are converted to dictionaries.
+    Returns:
+        A dictionary, e.g. {'method': 'sendMessage', 'chat_id': 1, 'text': 'Hi'}.
+    """
+    head, *tail = method.split('_')
+    payload = {'method': head + ''.join(word.capitalize() for word in tail)}
+    for name, value in kwargs.items():
+        if value is None:
+            continue
+        payload[name] = value.to_dict() if hasattr(value, 'to_dict') else value
+    return payload